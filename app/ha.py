@@ -0,0 +1,43 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def check_health(url: str, port: int, timeout: float = 5) -> bool:
+    """returns if the dls instance answers its health endpoint (certificates are not verified, they are often self-signed)"""
+    from ssl import create_default_context, CERT_NONE
+    from urllib.request import urlopen
+
+    context = create_default_context()
+    context.check_hostname, context.verify_mode = False, CERT_NONE
+    try:
+        with urlopen(f'https://{url}:{port}/-/health', timeout=timeout, context=context) as response:
+            return response.status == 200
+    except Exception as e:
+        logger.debug('health check of "%s:%s" failed: %s', url, port, e)
+        return False
+
+
+class NodeHealth:
+    """
+    Health of all nodes (primary and secondary) of this service instance, used as "node_query_order" for clients, so
+    they query healthy nodes first. This node is always healthy (it is answering), peers are probed periodically.
+    """
+
+    def __init__(self, nodes: [(str, int)], local: int, check=check_health):
+        self.nodes, self.local, self.__check = nodes, local, check
+        self.healthy = [True] * len(nodes)  # peers are assumed healthy until the first probe
+
+    def probe(self):
+        """checks all peers (blocking), so run it in a thread"""
+        for idx, (url, port) in enumerate(self.nodes):
+            if idx == self.local:
+                continue
+            healthy = self.__check(url, port)
+            if healthy != self.healthy[idx]:
+                logger.warning('Node "%s:%s" is %s.', url, port, 'healthy' if healthy else 'unhealthy')
+            self.healthy[idx] = healthy
+
+    def query_order(self) -> [int]:
+        """node indexes, healthy nodes first, each group in configured order (primary first)"""
+        return sorted(range(len(self.nodes)), key=lambda idx: (not self.healthy[idx], idx))
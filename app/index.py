@@ -0,0 +1,62 @@
+from datetime import datetime
+
+
+class LeaseIndex:
+    """
+    In-memory index of all leases by "lease_ref" and "origin_ref", so lease lookups do not need the database.
+
+    It is warmed from the "lease" table on startup and kept coherent by updating it after every successful write
+    (write-through). Only updated from the event-loop, so no locks are needed. As it lives in one process, it is only
+    coherent if a single worker is writing to the database.
+    """
+
+    def __init__(self):
+        self.ready = False  # lookups must fall back to the database until the index is warmed
+        self.__leases = {}  # lease_ref -> [origin_ref, lease_expires]
+        self.__origins = {}  # origin_ref -> {lease_ref, ...}
+
+    def __len__(self):
+        return len(self.__leases)
+
+    def warm(self, leases: [(str, str, datetime)]):
+        """replaces the index with (lease_ref, origin_ref, lease_expires) rows, only before it is used (on startup)"""
+        self.__leases, self.__origins = {}, {}
+        for lease_ref, origin_ref, lease_expires in leases:
+            self.put(lease_ref, origin_ref, lease_expires)
+        self.ready = True
+
+    def put(self, lease_ref: str, origin_ref: str, lease_expires: datetime):
+        self.__leases[lease_ref] = [origin_ref, lease_expires]
+        self.__origins.setdefault(origin_ref, set()).add(lease_ref)
+
+    def renew(self, lease_ref: str, lease_expires: datetime):
+        if lease_ref in self.__leases:
+            self.__leases[lease_ref][1] = lease_expires
+
+    def remove(self, lease_ref: str):
+        entry = self.__leases.pop(lease_ref, None)
+        if entry is not None:
+            refs = self.__origins.get(entry[0])
+            refs.discard(lease_ref)
+            if len(refs) == 0:
+                del self.__origins[entry[0]]
+
+    def remove_origin(self, origin_ref: str) -> [str]:
+        refs = self.__origins.pop(origin_ref, set())
+        for lease_ref in refs:
+            del self.__leases[lease_ref]
+        return list(refs)
+
+    def get_origin_ref(self, lease_ref: str) -> str:
+        entry = self.__leases.get(lease_ref)
+        return None if entry is None else entry[0]
+
+    def exists(self, origin_ref: str, lease_ref: str, now: datetime = None) -> bool:
+        """if "now" is given, only leases which are still active at "now" exist"""
+        entry = self.__leases.get(lease_ref)
+        return entry is not None and entry[0] == origin_ref and (now is None or entry[1] > now)
+
+    def find_by_origin_ref(self, origin_ref: str, now: datetime = None) -> [str]:
+        """all leases of the origin, or (if "now" is given) only the ones which are still active at "now" """
+        refs = self.__origins.get(origin_ref, ())
+        return list(refs) if now is None else [_ for _ in refs if self.__leases[_][1] > now]
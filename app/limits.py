@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class RateLimited(Exception):
+    """the request is over a limit, it should be answered with "429 Too Many Requests" """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f'rate limited by {reason}, retry after {retry_after:.1f} seconds')
+        self.reason, self.retry_after = reason, retry_after
+
+
+class TokenBuckets:
+    """
+    Token bucket per key (e.g. origin or client ip): every request takes a token, buckets hold up to "burst" tokens and
+    are refilled with "rate" tokens per second. Buckets of idle keys are full anyway, so only the "maxsize" most recently
+    used buckets are kept. Only used from the event-loop, so no locks are needed.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 65536, clock=monotonic):
+        self.rate, self.burst, self.maxsize, self.__clock = rate, max(1.0, burst), maxsize, clock
+        self.__buckets = OrderedDict()  # key -> (tokens, updated)
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def acquire(self, key: str) -> float:
+        """takes a token of "key", returns 0 if one was available, otherwise the seconds until one is"""
+        now = self.__clock()
+        tokens, updated = self.__buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        retry_after = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+
+        self.__buckets[key] = (tokens, now)
+        if len(self.__buckets) > self.maxsize:
+            self.__buckets.popitem(last=False)
+        return retry_after
+
+
+class ConcurrencyLimit:
+    """
+    Admits at most "limit" concurrent operations, further ones are rejected immediately (instead of queued), so a burst
+    can not pile up. Only used from the event-loop, so no locks are needed.
+    """
+
+    def __init__(self, limit: int):
+        self.limit, self.active = limit, 0
+
+    def acquire(self) -> bool:
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
@@ -0,0 +1,136 @@
+import logging
+from atexit import register
+from datetime import datetime, timezone
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from time import perf_counter
+
+FORMATS = ('text', 'json')
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per record, with the request fields set by "RequestLogMiddleware" (if any)"""
+
+    FIELDS = ('event', 'origin_ref', 'method', 'route', 'status', 'latency_ms', 'sampled')
+
+    def __init__(self, serializer: "Serializer"):
+        super().__init__()
+        self.__serializer = serializer
+
+    def format(self, record: logging.LogRecord) -> str:
+        x = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                x[field] = getattr(record, field)
+        if record.exc_info:
+            x['exception'] = self.formatException(record.exc_info)
+        return self.__serializer.dumps(x).decode('utf-8')
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps only every n-th record of high volume events (records with an "event" in "rates", e.g. {"renew": 10}). Kept
+    records get the rate as "sampled" field. As filter of the queue handler, dropped records are never queued.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = {event: rate for event, rate in rates.items() if rate > 1}
+        self.__counters = {event: count() for event in self.rates.keys()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        if event not in self.rates:
+            return True
+        record.sampled = self.rates[event]
+        return next(self.__counters[event]) % self.rates[event] == 0
+
+
+class _QueueListener(QueueListener):
+    def stop(self):
+        if self._thread is not None:  # stopped on exit, even if it was stopped before
+            super().stop()
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue never leaves the process, so records are not pickled and are formatted by the listener thread
+        return record
+
+
+def setup(format: str = 'text', sample: dict = None, serializer: "Serializer" = None, logger: logging.Logger = None,
+          stream=None) -> QueueListener:
+    """
+    Routes all records of "logger" (default: root) through a queue to a listener thread, which formats and writes them
+    to "stream" (default: stderr), so logging never blocks the event-loop on formatting or I/O. Like
+    "logging.basicConfig", nothing is changed if the logger already has handlers. Returns the started listener, which
+    is stopped (and drained) on exit.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'unknown log format "{format}", choose one of: {", ".join(FORMATS)}')
+
+    logger = logger or logging.getLogger()
+    if len(logger.handlers) > 0:
+        return None
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter(serializer) if format == 'json' else logging.Formatter(logging.BASIC_FORMAT))
+
+    queue = SimpleQueue()
+    queue_handler = _QueueHandler(queue)
+    queue_handler.addFilter(SampleFilter(sample or {}))
+    logger.addHandler(queue_handler)
+
+    listener = _QueueListener(queue, handler, respect_handler_level=True)
+    listener.start()
+    register(listener.stop)
+    return listener
+
+
+def log_request(request: "Request", event: str, origin_ref: str, msg: str, *args):
+    """
+    Registers the log record of a request, it is written by "RequestLogMiddleware" once the response is sent. "msg"
+    is only formatted with "args" (lazily) if the record is written.
+    """
+    request.state.log = (event, origin_ref, msg, args)
+
+
+class RequestLogMiddleware:
+    """
+    pure asgi middleware, which writes the record registered with "log_request" (if any) with status, latency and origin
+    of the request, e.g. "> [  renew   ]: <origin_ref>: renew <lease_ref>"
+    """
+
+    def __init__(self, app, logger: logging.Logger):
+        self.app, self.logger = app, logger
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status, start = 500, perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            x = scope.get('state', {}).get('log')
+            if x is not None:
+                event, origin_ref, msg, args = x
+                route = scope.get('route')
+                self.logger.info(f'> [%s]: %s: {msg}', event.center(10), origin_ref, *args, extra={
+                    'event': event, 'origin_ref': origin_ref, 'method': scope['method'],
+                    'route': route.path if route is not None else None, 'status': status,
+                    'latency_ms': round((perf_counter() - start) * 1000, 3),
+                })
@@ -1,26 +1,50 @@
 import logging
+from asyncio import get_running_loop, create_task, gather, sleep, CancelledError
 from base64 import b64encode as b64enc
 from hashlib import sha256
 from uuid import uuid4
-from os.path import join, dirname
+from os.path import join, dirname, getmtime
 from os import getenv as env
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from math import ceil
+from time import perf_counter, time
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 from fastapi.requests import Request
-from json import loads as json_loads
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from calendar import timegm
-from jose import jws, jwk, jwt, JWTError
-from jose.constants import ALGORITHMS
+from email.utils import formatdate, parsedate_to_datetime
+from jose import JWTError
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse, JSONResponse as JSONr, HTMLResponse as HTMLr, Response, RedirectResponse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import StreamingResponse, HTMLResponse as HTMLr, Response, RedirectResponse
+
+from util import load_key, load_file, ExpiringLRUCache
+from signer import create_signer
+from serializer import create_serializer, create_response_class
+from index import LeaseIndex
+from renewals import RenewalQueue, RenewalScheduler
+from limits import RateLimited, TokenBuckets, ConcurrencyLimit
+from ha import NodeHealth
+from metrics import Registry, Counter, Gauge, Histogram, MetricsMiddleware
+from logs import setup as setup_logging, log_request, RequestLogMiddleware
+from orm import Origin, Lease, Lock, RateLimit, upgrade as db_upgrade, create_engine
+
+startup_timings = {}  # seconds spent in each startup phase, see "test/bench_startup.py"
+
+
+@contextmanager
+def __phase(name: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = perf_counter() - start
 
-from util import load_key, load_file
-from orm import Origin, Lease, init as db_init, migrate
 
 load_dotenv('../version.env')
 
@@ -30,28 +54,129 @@ VERSION, COMMIT, DEBUG = env('VERSION', 'unknown'), env('COMMIT', 'unknown'), bo
 
 config = dict(openapi_url=None, docs_url=None, redoc_url=None)  # dict(openapi_url='/-/openapi.json', docs_url='/-/docs', redoc_url='/-/redoc')
 app = FastAPI(title='FastAPI-DLS', description='Minimal Delegated License Service (DLS).', version=VERSION, **config)
-db = create_engine(str(env('DATABASE', 'sqlite:///db.sqlite')))
-db_init(db), migrate(db)
+with __phase('database'):
+    db = create_engine(
+        str(env('DATABASE', 'sqlite:///db.sqlite')),
+        pool_size=int(env('DATABASE_POOL_SIZE', 5)),
+        max_overflow=int(env('DATABASE_POOL_MAX_OVERFLOW', 10)),
+        pool_recycle=int(env('DATABASE_POOL_RECYCLE', -1)),
+        pool_pre_ping=str(env('DATABASE_POOL_PRE_PING', 'false')).lower() == 'true',
+        sqlite_wal=str(env('DATABASE_SQLITE_WAL', 'false')).lower() == 'true',
+        sqlite_check_same_thread=str(env('DATABASE_SQLITE_CHECK_SAME_THREAD', 'false')).lower() == 'true',
+    )
+    db_upgrade(db)  # only inspects and migrates the database if its schema version is outdated
+db_executor = ThreadPoolExecutor(max_workers=int(env('DATABASE_WORKERS', 8)), thread_name_prefix='db')
 
 # everything prefixed with "INSTANCE_*" is used as "SERVICE_INSTANCE_*" or "SI_*" in official dls service
 DLS_URL = str(env('DLS_URL', 'localhost'))
 DLS_PORT = int(env('DLS_PORT', '443'))
+DLS_URL_SECONDARY = env('DLS_URL_SECONDARY', None)
+DLS_PORT_SECONDARY = int(env('DLS_PORT_SECONDARY', DLS_PORT))
+DLS_NODES = [(DLS_URL, DLS_PORT)] + ([(DLS_URL_SECONDARY, DLS_PORT_SECONDARY)] if DLS_URL_SECONDARY else [])
+HA_ROLE = str(env('HA_ROLE', 'primary')).lower()
+HA_HEALTH_INTERVAL = int(env('HA_HEALTH_INTERVAL', 15))
 SITE_KEY_XID = str(env('SITE_KEY_XID', '00000000-0000-0000-0000-000000000000'))
 INSTANCE_REF = str(env('INSTANCE_REF', '10000000-0000-0000-0000-000000000001'))
 ALLOTMENT_REF = str(env('ALLOTMENT_REF', '20000000-0000-0000-0000-000000000001'))
-INSTANCE_KEY_RSA = load_key(str(env('INSTANCE_KEY_RSA', join(dirname(__file__), 'cert/instance.private.pem'))))
-INSTANCE_KEY_PUB = load_key(str(env('INSTANCE_KEY_PUB', join(dirname(__file__), 'cert/instance.public.pem'))))
+with __phase('keys'):
+    INSTANCE_KEY_RSA = load_key(str(env('INSTANCE_KEY_RSA', join(dirname(__file__), 'cert/instance.private.pem'))))
+    INSTANCE_KEY_PUB = load_key(str(env('INSTANCE_KEY_PUB', join(dirname(__file__), 'cert/instance.public.pem'))))
 TOKEN_EXPIRE_DELTA = relativedelta(days=int(env('TOKEN_EXPIRE_DAYS', 1)), hours=int(env('TOKEN_EXPIRE_HOURS', 0)))
 LEASE_EXPIRE_DELTA = relativedelta(days=int(env('LEASE_EXPIRE_DAYS', 90)), hours=int(env('LEASE_EXPIRE_HOURS', 0)))
 LEASE_RENEWAL_PERIOD = float(env('LEASE_RENEWAL_PERIOD', 0.15))
 LEASE_RENEWAL_DELTA = timedelta(days=int(env('LEASE_EXPIRE_DAYS', 90)), hours=int(env('LEASE_EXPIRE_HOURS', 0)))
 CLIENT_TOKEN_EXPIRE_DELTA = relativedelta(years=12)
 CORS_ORIGINS = str(env('CORS_ORIGINS', '')).split(',') if (env('CORS_ORIGINS')) else [f'https://{DLS_URL}']
-
-jwt_encode_key = jwk.construct(INSTANCE_KEY_RSA.export_key().decode('utf-8'), algorithm=ALGORITHMS.RS256)
-jwt_decode_key = jwk.construct(INSTANCE_KEY_PUB.export_key().decode('utf-8'), algorithm=ALGORITHMS.RS256)
+TOKEN_CACHE_SIZE = int(env('TOKEN_CACHE_SIZE', 4096))
+CLIENT_TOKEN_CACHE_SECONDS = int(env('CLIENT_TOKEN_CACHE_SECONDS', 0))
+JWT_BACKEND = str(env('JWT_BACKEND', 'auto'))
+JSON_BACKEND = str(env('JSON_BACKEND', 'auto'))
+METRICS_DIR = env('METRICS_DIR', None)
+CLUSTER = str(env('CLUSTER', 'false')).lower() == 'true'
+LEASE_INDEX = str(env('LEASE_INDEX', 'false')).lower() == 'true' and not CLUSTER
+LEASE_RENEWAL_WRITE_BEHIND = float(env('LEASE_RENEWAL_WRITE_BEHIND', 0)) if not CLUSTER else 0
+LEASE_RENEWAL_BATCH_SIZE = int(env('LEASE_RENEWAL_BATCH_SIZE', 500))
+LEASE_RENEWAL_JITTER = float(env('LEASE_RENEWAL_JITTER', 0))
+LEASE_RENEWAL_TARGET_RATE = float(env('LEASE_RENEWAL_TARGET_RATE', 0))
+LEASE_REAPER_INTERVAL = int(env('LEASE_REAPER_INTERVAL', 0))
+LEASE_REAPER_CHUNK = int(env('LEASE_REAPER_CHUNK', 500))
+COMPRESSION_MIN_SIZE = int(env('COMPRESSION_MIN_SIZE', 0))
+RATE_LIMIT_ORIGIN = float(env('RATE_LIMIT_ORIGIN', 0))  # requests per second
+RATE_LIMIT_IP = float(env('RATE_LIMIT_IP', 0))
+RATE_LIMIT_BURST = float(env('RATE_LIMIT_BURST', 10))  # seconds of "RATE_LIMIT_*" which may be used at once
+RATE_LIMIT_SHARED = str(env('RATE_LIMIT_SHARED', 'false')).lower() == 'true'
+SIGNING_CONCURRENCY = int(env('SIGNING_CONCURRENCY', 0))
+LEASE_QUOTA = int(env('LEASE_QUOTA', 0))  # per scope (allotment)
+LOG_FORMAT = str(env('LOG_FORMAT', 'text')).lower()
+LOG_SAMPLE_RENEW = int(env('LOG_SAMPLE_RENEW', 1))
+ADMIN_PAGE_SIZE = 1000  # rows fetched per query when streaming admin listings
+
+with __phase('signer'):
+    jwt_signer = create_signer(INSTANCE_KEY_RSA, INSTANCE_KEY_PUB, backend=JWT_BACKEND)
+json_serializer = create_serializer(backend=JSON_BACKEND)
+JSONr = create_response_class(json_serializer)  # used for all json responses
+token_cache = ExpiringLRUCache(maxsize=TOKEN_CACHE_SIZE)  # verified tokens by their digest
+background_tasks = set()  # periodic tasks started on startup, cancelled on shutdown
+lease_index = LeaseIndex() if LEASE_INDEX else None  # warmed on startup
+renewal_queue = None  # write-behind for lease renewals, if "LEASE_RENEWAL_WRITE_BEHIND" is set
+renewal_scheduler = RenewalScheduler(LEASE_RENEWAL_PERIOD, jitter=LEASE_RENEWAL_JITTER, target_rate=LEASE_RENEWAL_TARGET_RATE)
+if HA_ROLE not in ('primary', 'secondary'):
+    raise ValueError(f'unknown ha role "{HA_ROLE}", choose one of: primary, secondary')
+node_health = NodeHealth(DLS_NODES, local=int(HA_ROLE == 'secondary')) if len(DLS_NODES) > 1 else None  # failover
+worker_ref = str(uuid4())  # identifies this process, e.g. as holder of database locks
+rate_limits = {  # token buckets by limit, per process (or in the database, if "RATE_LIMIT_SHARED" is set)
+    'origin': TokenBuckets(RATE_LIMIT_ORIGIN, RATE_LIMIT_ORIGIN * RATE_LIMIT_BURST) if RATE_LIMIT_ORIGIN > 0 else None,
+    'ip': TokenBuckets(RATE_LIMIT_IP, RATE_LIMIT_IP * RATE_LIMIT_BURST) if RATE_LIMIT_IP > 0 else None,
+}
+signing_limit = ConcurrencyLimit(SIGNING_CONCURRENCY) if SIGNING_CONCURRENCY > 0 else None
+signing_executor = ThreadPoolExecutor(max_workers=SIGNING_CONCURRENCY, thread_name_prefix='signing') if SIGNING_CONCURRENCY > 0 else None
+
+# everything except "jti" and timestamps of the client-token is static while the process is running
+client_token_configuration = {
+    "update_mode": "ABSOLUTE",
+    "scope_ref_list": [ALLOTMENT_REF],
+    "fulfillment_class_ref_list": [],
+    "service_instance_configuration": {
+        "nls_service_instance_ref": INSTANCE_REF,
+        "svc_port_set_list": [
+            {
+                "idx": idx,
+                "d_name": "DLS",
+                "svc_port_map": [{"service": "auth", "port": port}, {"service": "lease", "port": port}]
+            } for idx, (url, port) in enumerate(DLS_NODES)
+        ],
+        "node_url_list": [{"idx": idx, "url": url, "url_qr": url, "svc_port_set_idx": idx} for idx, (url, port) in enumerate(DLS_NODES)]
+    },
+    "service_instance_public_key_configuration": {
+        "service_instance_public_key_me": {
+            "mod": hex(INSTANCE_KEY_PUB.public_key().n)[2:],
+            "exp": int(INSTANCE_KEY_PUB.public_key().e),
+        },
+        "service_instance_public_key_pem": INSTANCE_KEY_PUB.export_key().decode('utf-8'),
+        "key_retention_mode": "LATEST_ONLY"
+    },
+}
+client_token_cache = {'content': None, 'created': None}  # signed client-token, if "CLIENT_TOKEN_CACHE_SECONDS" is set
+change_counters = {'origin': 0}  # writes of this process, for etags of tables without timestamps
+readme_cache = {}  # rendered (and compressed) readme, it does not change while the process is running
+
+registry = Registry(directory=METRICS_DIR)
+metric_requests = registry.register(Counter('dls_http_requests_total', 'Number of requests.', labels=('method', 'route', 'status')))
+metric_request_duration = registry.register(Histogram('dls_http_request_duration_seconds', 'Request latency.', labels=('method', 'route')))
+metric_db_duration = registry.register(Histogram('dls_db_query_duration_seconds', 'Database operation latency.', labels=('operation',)))
+metric_jwt_duration = registry.register(Histogram('dls_jwt_duration_seconds', 'JWT sign and verify latency.', labels=('operation',)))
+metric_leases_active = registry.register(Gauge('dls_leases_active', 'Number of active leases.', shared=False))
+metric_leases_expiring = registry.register(Gauge('dls_leases_expiring', 'Number of active leases expiring within one renewal interval.', shared=False))
+metric_leases_reaped = registry.register(Counter('dls_leases_reaped_total', 'Number of expired leases removed by the reaper.'))
+metric_requests_limited = registry.register(Counter('dls_requests_limited_total', 'Number of requests rejected by limits.', labels=('reason',)))
+
+log_listener = setup_logging(format=LOG_FORMAT, sample={'renew': LOG_SAMPLE_RENEW}, serializer=json_serializer)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
 app.debug = DEBUG
+app.add_middleware(MetricsMiddleware, requests=metric_requests, latency=metric_request_duration)
+app.add_middleware(RequestLogMiddleware, logger=logger)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -59,16 +184,241 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*'],
 )
+if COMPRESSION_MIN_SIZE > 0:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_SIZE, compresslevel=6)
+
+
+def __timed(func, *args, **kwargs) -> tuple:
+    start = perf_counter()
+    return func(*args, **kwargs), perf_counter() - start
+
+
+async def __db(func, *args, **kwargs):
+    # database calls are blocking, so run them in a bounded thread-pool to keep the event-loop responsive
+    result, duration = await get_running_loop().run_in_executor(db_executor, partial(__timed, func, *args, **kwargs))
+    metric_db_duration.observe(duration, operation=func.__qualname__)
+    return result
+
+
+async def __periodic(func, interval: float):
+    # runs "func" (sync or async) every "interval" seconds until the task is cancelled on shutdown
+    while True:
+        await sleep(interval)
+        try:
+            result = func()
+            if hasattr(result, '__await__'):
+                await result
+        except CancelledError:
+            raise
+        except Exception as e:
+            logger.exception('background task "%s" failed: %s', func.__qualname__, e)
+
+
+def __index() -> LeaseIndex:
+    # returns the lease index, if it is enabled and ready to answer lookups
+    return lease_index if lease_index is not None and lease_index.ready else None
 
-logging.basicConfig()
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+
+async def __renew_many(renewals: list):
+    await __db(Lease.renew_many, db, renewals)
+
+
+if LEASE_RENEWAL_WRITE_BEHIND > 0:
+    renewal_queue = RenewalQueue(flush=__renew_many, window=LEASE_RENEWAL_WRITE_BEHIND, batch_size=LEASE_RENEWAL_BATCH_SIZE)
+
+
+async def __warm_index():
+    # only on startup, afterwards the index is updated with every write (a snapshot would lose concurrent writes)
+    if lease_index is not None:
+        lease_index.warm(await __db(Lease.find_refs, db))
+
+
+def __render_readme() -> dict:
+    # blocking (markdown rendering takes a while), so run it in a thread
+    from gzip import compress
+    from markdown import markdown
+
+    filename = '../README.md'
+    content = load_file(filename).decode('utf-8')
+    html = markdown(text=content, extensions=['tables', 'fenced_code', 'md_in_html', 'nl2br', 'toc']).encode('utf-8')
+    modified = int(getmtime(filename))
+
+    encoded = {'gzip': compress(html, compresslevel=9)}
+    try:
+        import brotli
+        encoded['br'] = brotli.compress(html)
+    except ModuleNotFoundError:
+        pass
+
+    # weak etag, so it is valid for all encodings
+    etag = f'W/"{sha256(html).hexdigest()[:32]}"'
+    return dict(html=html, encoded=encoded, etag=etag, modified=modified, last_modified=formatdate(modified, usegmt=True))
+
+
+def __etag(*parts) -> str:
+    # weak etag (valid for all content-encodings) of anything, which changes if the content changes
+    return f'W/"{sha256(repr(parts).encode("utf-8")).hexdigest()[:32]}"'
+
+
+def __not_modified(request: Request, etag: str, modified: int = None) -> bool:
+    # conditional get, "If-None-Match" takes precedence over "If-Modified-Since" (rfc 9110)
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return any(_.strip() in ('*', etag, etag.removeprefix('W/')) for _ in if_none_match.split(','))
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and modified is not None:
+        try:
+            return modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def __accepted_encoding(request: Request, available) -> str:
+    # returns the preferred available content-encoding the client accepts (ignoring weights, except "q=0")
+    accepted = set()
+    for x in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = x.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    return next((_ for _ in ('br', 'gzip') if _ in available and _ in accepted), None)
+
+
+async def __probe_nodes():
+    await get_running_loop().run_in_executor(None, node_health.probe)
+
+
+async def __delete_idle_rate_limits() -> int:
+    # buckets are full after "RATE_LIMIT_BURST" seconds without requests, so they can be deleted (by any worker)
+    return await __db(RateLimit.delete_idle, db, time() - RATE_LIMIT_BURST)
+
+
+async def __reap_expired_leases() -> int:
+    """deletes expired leases in chunks, only one worker (holding the "lease_reaper" lock) does this at a time"""
+    ttl = timedelta(seconds=LEASE_REAPER_INTERVAL * 2)  # if the holder dies, another worker takes over
+    if not await __db(Lock.acquire, db, 'lease_reaper', worker_ref, ttl):
+        return 0
+
+    deletions, expires_before = 0, datetime.utcnow()
+    while True:
+        lease_refs = await __db(Lease.delete_expired_chunk, db, expires_before, LEASE_REAPER_CHUNK)
+        if __index() is not None:
+            for lease_ref in lease_refs:
+                __index().remove(lease_ref)
+        deletions += len(lease_refs)
+        metric_leases_reaped.inc(len(lease_refs))
+        if len(lease_refs) < LEASE_REAPER_CHUNK:
+            break
+        await sleep(0)  # every chunk is its own short transaction, so renewals are not blocked in between
+    if deletions > 0:
+        logger.info('Lease reaper removed %d expired leases.', deletions)
+    return deletions
+
+
+async def __sign(payload: dict, headers: dict = None) -> str:
+    if signing_limit is None:
+        with metric_jwt_duration.time(operation='sign'):
+            return jwt_signer.sign(payload, headers=headers)
+
+    # signing is cpu-bound, so it runs in a bounded thread-pool (the native rsa code releases the gil) and requests
+    # beyond the pool are rejected instead of queueing up on the event-loop in front of cheap ones, like renewals
+    if not signing_limit.acquire():
+        raise RateLimited('signing', retry_after=1)
+    try:
+        with metric_jwt_duration.time(operation='sign'):
+            return await get_running_loop().run_in_executor(signing_executor, partial(jwt_signer.sign, payload, headers=headers))
+    finally:
+        signing_limit.release()
+
+
+async def __rate_limit(request: Request, origin_ref: str = None, limits: tuple = ('ip', 'origin')):
+    """
+    takes a token of the origin and the client ip, raises "RateLimited" if one of them has none left. Handlers which
+    verify a token first take the ip token before (so junk tokens are limited too), and the origin token after it.
+    Handlers without a token only take the ip token, so nobody can drain the bucket of someone else's origin_ref.
+    """
+    for limit, key in (('ip', request.client.host if request.client is not None else None), ('origin', origin_ref)):
+        buckets = rate_limits.get(limit)
+        if buckets is None or key is None or limit not in limits:
+            continue
+        if RATE_LIMIT_SHARED:
+            retry_after = await __db(RateLimit.acquire, db, f'{limit}:{key}', buckets.rate, buckets.burst, time())
+        else:
+            retry_after = buckets.acquire(key)
+        if retry_after > 0:
+            raise RateLimited(limit, retry_after=retry_after)
+
+
+def __decode_token(token: str) -> dict:
+    # verifying the signature is expensive, so already verified tokens are cached until they expire
+    digest = sha256(token.encode('utf-8')).digest()
+    payload = token_cache.get(digest)
+    if payload is None:
+        with metric_jwt_duration.time(operation='verify'):
+            payload = jwt_signer.decode(token, options={'verify_aud': False})
+        if payload.get('exp') is not None:
+            token_cache.put(digest, payload, expires=float(payload.get('exp')))
+    return payload
+
+
+async def __listing(request: Request, find_page, options: dict, serialize, cursor, limit: int, after: str, format: str, state: tuple = None):
+    """
+    Keyset paginated listing. With "limit" only one page is returned and the cursor for the next page is sent in the
+    "X-Next-Cursor" header. Without "limit" all rows are streamed, fetched page by page, so memory usage stays constant.
+    Rows are returned as json array or, if requested by "format=ndjson" or "Accept" header, as newline delimited json.
+    If "state" (which changes whenever the rows change) is given, it is used as etag for conditional requests.
+    """
+    ndjson = format == 'ndjson' or 'application/x-ndjson' in request.headers.get('accept', '')
+    media_type = 'application/x-ndjson' if ndjson else 'application/json'
+
+    headers = {}
+    if state is not None:
+        headers['ETag'] = __etag(state, str(request.url.query), ndjson)
+        if __not_modified(request, headers['ETag']):
+            return Response(status_code=304, headers=headers)
+
+    def dumps(rows: list) -> bytes:
+        x = [json_serializer.dumps(serialize(_)) for _ in rows]
+        return b''.join(_ + b'\n' for _ in x) if ndjson else b','.join(x)
+
+    if limit is not None:
+        rows = await __db(find_page, db, after=after, limit=limit, **options)
+        if len(rows) > 0 and len(rows) == limit:
+            headers['X-Next-Cursor'] = cursor(rows[-1])
+        return Response(dumps(rows) if ndjson else b'[' + dumps(rows) + b']', media_type=media_type, headers=headers)
+
+    async def stream():
+        page_after, separator = after, b''
+        if not ndjson:
+            yield b'['
+        while True:
+            rows = await __db(find_page, db, after=page_after, limit=ADMIN_PAGE_SIZE, **options)
+            if len(rows) > 0:
+                yield dumps(rows) if ndjson else separator + dumps(rows)
+                separator = b','
+            if len(rows) < ADMIN_PAGE_SIZE:
+                break
+            page_after = cursor(rows[-1])
+        if not ndjson:
+            yield b']'
+
+    return StreamingResponse(stream(), media_type=media_type, headers=headers)
 
 
 def __get_token(request: Request) -> dict:
-    authorization_header = request.headers.get('authorization')
-    token = authorization_header.split(' ')[1]
-    return jwt.decode(token=token, key=jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
+    if not hasattr(request.state, 'token'):
+        authorization_header = request.headers.get('authorization')
+        token = authorization_header.split(' ')[1]
+        request.state.token = __decode_token(token)
+    return request.state.token
+
+
+@app.exception_handler(RateLimited)
+async def __rate_limited(request: Request, e: RateLimited):
+    metric_requests_limited.inc(reason=e.reason)
+    headers = {'Retry-After': str(max(1, ceil(e.retry_after)))}
+    return JSONr(status_code=429, content={'status': 429, 'detail': 'too many requests'}, headers=headers)
 
 
 @app.get('/', summary='Index')
@@ -86,14 +436,26 @@ async def _health():
     return JSONr({'status': 'up'})
 
 
+@app.get('/-/metrics', summary='* Metrics', description='returns metrics in prometheus format.')
+async def _metrics():
+    expiring_before = datetime.utcnow() + Lease.calculate_renewal(LEASE_RENEWAL_PERIOD, LEASE_RENEWAL_DELTA)
+    active, expiring = await __db(Lease.count_active, db, expiring_before)
+    metric_leases_active.set(active)
+    metric_leases_expiring.set(expiring)
+    return Response(registry.expose(), media_type='text/plain; version=0.0.4')
+
+
 @app.get('/-/config', summary='* Config', description='returns environment variables.')
-async def _config():
-    return JSONr({
+async def _config(request: Request):
+    response = JSONr({
         'VERSION': str(VERSION),
         'COMMIT': str(COMMIT),
         'DEBUG': str(DEBUG),
         'DLS_URL': str(DLS_URL),
         'DLS_PORT': str(DLS_PORT),
+        'DLS_URL_SECONDARY': str(DLS_URL_SECONDARY),
+        'DLS_PORT_SECONDARY': str(DLS_PORT_SECONDARY),
+        'HA_ROLE': str(HA_ROLE),
         'SITE_KEY_XID': str(SITE_KEY_XID),
         'INSTANCE_REF': str(INSTANCE_REF),
         'ALLOTMENT_REF': [str(ALLOTMENT_REF)],
@@ -101,15 +463,29 @@ async def _config():
         'LEASE_EXPIRE_DELTA': str(LEASE_EXPIRE_DELTA),
         'LEASE_RENEWAL_PERIOD': str(LEASE_RENEWAL_PERIOD),
         'CORS_ORIGINS': str(CORS_ORIGINS),
+        'CLUSTER': str(CLUSTER),
         'TZ': str(TZ),
     })
+    response.headers['ETag'] = __etag(response.body)
+    if __not_modified(request, response.headers['ETag']):
+        return Response(status_code=304, headers={'ETag': response.headers['ETag']})
+    return response
 
 
 @app.get('/-/readme', summary='* Readme')
-async def _readme():
-    from markdown import markdown
-    content = load_file('../README.md').decode('utf-8')
-    return HTMLr(markdown(text=content, extensions=['tables', 'fenced_code', 'md_in_html', 'nl2br', 'toc']))
+async def _readme(request: Request):
+    if len(readme_cache) == 0:
+        readme_cache.update(await get_running_loop().run_in_executor(None, __render_readme))
+
+    headers = {'ETag': readme_cache['etag'], 'Last-Modified': readme_cache['last_modified'], 'Vary': 'Accept-Encoding'}
+    if __not_modified(request, readme_cache['etag'], readme_cache['modified']):
+        return Response(status_code=304, headers=headers)
+
+    encoding = __accepted_encoding(request, readme_cache['encoded'].keys())
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+        return HTMLr(readme_cache['encoded'][encoding], headers=headers)
+    return HTMLr(readme_cache['html'], headers=headers)
 
 
 @app.get('/-/manage', summary='* Management UI')
@@ -151,50 +527,67 @@ async def _manage(request: Request):
 
 
 @app.get('/-/origins', summary='* Origins')
-async def _origins(request: Request, leases: bool = False):
-    session = sessionmaker(bind=db)()
-    response = []
-    for origin in session.query(Origin).all():
+async def _origins(request: Request, leases: bool = False, limit: int = Query(None, ge=1, le=ADMIN_PAGE_SIZE), after: str = None, format: str = 'json'):
+    def serialize(row: tuple) -> dict:
+        origin, origin_leases = row
         x = origin.serialize()
         if leases:
-            serialize = dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
-            x['leases'] = list(map(lambda _: _.serialize(**serialize), Lease.find_by_origin_ref(db, origin.origin_ref)))
-        response.append(x)
-    session.close()
-    return JSONr(response)
+            serialize_lease = dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
+            x['leases'] = list(map(lambda _: _.serialize(**serialize_lease), origin_leases))
+        return x
+
+    # origins have no timestamps, so only this process knows about changes (not usable with multiple workers)
+    state = None
+    if not CLUSTER:
+        lease_state = await __db(Lease.state, db) if leases else None
+        state = (worker_ref, change_counters['origin'], await __db(Origin.count, db), lease_state)
+
+    cursor = lambda row: row[0].origin_ref
+    return await __listing(request, Origin.find_page, dict(with_leases=leases), serialize, cursor, limit, after, format, state)
 
 
 @app.delete('/-/origins', summary='* Origins')
 async def _origins_delete(request: Request):
-    Origin.delete(db)
+    origin_refs = await __db(Origin.delete, db)
+    change_counters['origin'] += 1
+    if __index() is not None:
+        for origin_ref in origin_refs:
+            __index().remove_origin(origin_ref)
     return Response(status_code=201)
 
 
 @app.get('/-/leases', summary='* Leases')
-async def _leases(request: Request, origin: bool = False):
-    session = sessionmaker(bind=db)()
-    response = []
-    for lease in session.query(Lease).all():
-        serialize = dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
-        x = lease.serialize(**serialize)
-        if origin:
-            lease_origin = session.query(Origin).filter(Origin.origin_ref == lease.origin_ref).first()
-            if lease_origin is not None:
-                x['origin'] = lease_origin.serialize()
-        response.append(x)
-    session.close()
-    return JSONr(response)
+async def _leases(request: Request, origin: bool = False, limit: int = Query(None, ge=1, le=ADMIN_PAGE_SIZE), after: str = None, format: str = 'json'):
+    def serialize(row: tuple) -> dict:
+        lease, lease_origin = row
+        x = lease.serialize(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
+        if lease_origin is not None:
+            x['origin'] = lease_origin.serialize()
+        return x
+
+    # with origins, they are part of the etag too (origins are only changed by this process, see "/-/origins")
+    state = await __db(Lease.state, db)
+    if origin:
+        state = None if CLUSTER else (state, worker_ref, change_counters['origin'])
+
+    cursor = lambda row: row[0].lease_ref
+    return await __listing(request, Lease.find_page, dict(with_origin=origin), serialize, cursor, limit, after, format, state)
 
 
 @app.delete('/-/leases/expired', summary='* Leases')
 async def _lease_delete_expired(request: Request):
-    Lease.delete_expired(db)
+    lease_refs = await __db(Lease.delete_expired, db, LEASE_REAPER_CHUNK)
+    if __index() is not None:
+        for lease_ref in lease_refs:
+            __index().remove(lease_ref)
     return Response(status_code=201)
 
 
 @app.delete('/-/lease/{lease_ref}', summary='* Lease')
 async def _lease_delete(request: Request, lease_ref: str):
-    if Lease.delete(db, lease_ref) == 1:
+    if await __db(Lease.delete, db, lease_ref) == 1:
+        if __index() is not None:
+            __index().remove(lease_ref)
         return Response(status_code=201)
     return JSONr(status_code=404, content={'status': 404, 'detail': 'lease not found'})
 
@@ -203,40 +596,24 @@ async def _lease_delete(request: Request, lease_ref: str):
 @app.get('/-/client-token', summary='* Client-Token', description='creates a new messenger token for this service instance')
 async def _client_token():
     cur_time = datetime.utcnow()
-    exp_time = cur_time + CLIENT_TOKEN_EXPIRE_DELTA
-
-    payload = {
-        "jti": str(uuid4()),
-        "iss": "NLS Service Instance",
-        "aud": "NLS Licensed Client",
-        "iat": timegm(cur_time.timetuple()),
-        "nbf": timegm(cur_time.timetuple()),
-        "exp": timegm(exp_time.timetuple()),
-        "update_mode": "ABSOLUTE",
-        "scope_ref_list": [ALLOTMENT_REF],
-        "fulfillment_class_ref_list": [],
-        "service_instance_configuration": {
-            "nls_service_instance_ref": INSTANCE_REF,
-            "svc_port_set_list": [
-                {
-                    "idx": 0,
-                    "d_name": "DLS",
-                    "svc_port_map": [{"service": "auth", "port": DLS_PORT}, {"service": "lease", "port": DLS_PORT}]
-                }
-            ],
-            "node_url_list": [{"idx": 0, "url": DLS_URL, "url_qr": DLS_URL, "svc_port_set_idx": 0}]
-        },
-        "service_instance_public_key_configuration": {
-            "service_instance_public_key_me": {
-                "mod": hex(INSTANCE_KEY_PUB.public_key().n)[2:],
-                "exp": int(INSTANCE_KEY_PUB.public_key().e),
-            },
-            "service_instance_public_key_pem": INSTANCE_KEY_PUB.export_key().decode('utf-8'),
-            "key_retention_mode": "LATEST_ONLY"
-        },
-    }
 
-    content = jws.sign(payload, key=jwt_encode_key, headers=None, algorithm=ALGORITHMS.RS256)
+    created = client_token_cache.get('created')
+    if CLIENT_TOKEN_CACHE_SECONDS > 0 and created is not None and (cur_time - created).total_seconds() < CLIENT_TOKEN_CACHE_SECONDS:
+        content = client_token_cache.get('content')
+    else:
+        exp_time = cur_time + CLIENT_TOKEN_EXPIRE_DELTA
+        payload = {
+            "jti": str(uuid4()),
+            "iss": "NLS Service Instance",
+            "aud": "NLS Licensed Client",
+            "iat": timegm(cur_time.timetuple()),
+            "nbf": timegm(cur_time.timetuple()),
+            "exp": timegm(exp_time.timetuple()),
+            **client_token_configuration,
+        }
+        content = await __sign(payload)
+        if CLIENT_TOKEN_CACHE_SECONDS > 0:
+            client_token_cache.update(content=content, created=cur_time)
 
     response = StreamingResponse(iter([content]), media_type="text/plain")
     filename = f'client_configuration_token_{datetime.now().strftime("%d-%m-%y-%H-%M-%S")}.tok'
@@ -248,10 +625,11 @@ async def _client_token():
 # venv/lib/python3.9/site-packages/nls_services_auth/test/test_origins_controller.py
 @app.post('/auth/v1/origin', description='find or create an origin')
 async def auth_v1_origin(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
 
     origin_ref = j.get('candidate_origin_ref')
-    logging.info(f'> [  origin  ]: {origin_ref}: {j}')
+    await __rate_limit(request, limits=('ip',))  # origin_ref is not authenticated yet
+    log_request(request, 'origin', origin_ref, '%s', j)
 
     data = Origin(
         origin_ref=origin_ref,
@@ -260,7 +638,8 @@ async def auth_v1_origin(request: Request):
         os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
     )
 
-    Origin.create_or_update(db, data)
+    await __db(Origin.create_or_update, db, data)
+    change_counters['origin'] += 1
 
     response = {
         "origin_ref": origin_ref,
@@ -269,8 +648,14 @@ async def auth_v1_origin(request: Request):
         "node_url_list": None,
         "node_query_order": None,
         "prompts": None,
-        "sync_timestamp": cur_time.isoformat()
+        "sync_timestamp": cur_time
     }
+    if node_health is not None:
+        # clients query healthy nodes first, so they fail over without waiting for their renewal to fail
+        service_instance_configuration = client_token_configuration.get('service_instance_configuration')
+        response['svc_port_set_list'] = service_instance_configuration.get('svc_port_set_list')
+        response['node_url_list'] = service_instance_configuration.get('node_url_list')
+        response['node_query_order'] = node_health.query_order()
 
     return JSONr(response)
 
@@ -278,10 +663,11 @@ async def auth_v1_origin(request: Request):
 # venv/lib/python3.9/site-packages/nls_services_auth/test/test_origins_controller.py
 @app.post('/auth/v1/origin/update', description='update an origin evidence')
 async def auth_v1_origin_update(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
 
     origin_ref = j.get('origin_ref')
-    logging.info(f'> [  update  ]: {origin_ref}: {j}')
+    await __rate_limit(request, limits=('ip',))  # origin_ref is not authenticated yet
+    log_request(request, 'update', origin_ref, '%s', j)
 
     data = Origin(
         origin_ref=origin_ref,
@@ -290,12 +676,13 @@ async def auth_v1_origin_update(request: Request):
         os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
     )
 
-    Origin.create_or_update(db, data)
+    await __db(Origin.create_or_update, db, data)
+    change_counters['origin'] += 1
 
     response = {
         "environment": j.get('environment'),
         "prompts": None,
-        "sync_timestamp": cur_time.isoformat()
+        "sync_timestamp": cur_time
     }
 
     return JSONr(response)
@@ -305,10 +692,11 @@ async def auth_v1_origin_update(request: Request):
 # venv/lib/python3.9/site-packages/nls_core_auth/auth.py - CodeResponse
 @app.post('/auth/v1/code', description='get an authorization code')
 async def auth_v1_code(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
 
     origin_ref = j.get('origin_ref')
-    logging.info(f'> [   code   ]: {origin_ref}: {j}')
+    await __rate_limit(request, limits=('ip',))  # origin_ref is not authenticated yet
+    log_request(request, 'code', origin_ref, '%s', j)
 
     delta = relativedelta(minutes=15)
     expires = cur_time + delta
@@ -322,11 +710,11 @@ async def auth_v1_code(request: Request):
         'kid': SITE_KEY_XID
     }
 
-    auth_code = jws.sign(payload, key=jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
+    auth_code = await __sign(payload, headers={'kid': payload.get('kid')})
 
     response = {
         "auth_code": auth_code,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
         "prompts": None
     }
 
@@ -337,15 +725,18 @@ async def auth_v1_code(request: Request):
 # venv/lib/python3.9/site-packages/nls_core_auth/auth.py - TokenResponse
 @app.post('/auth/v1/token', description='exchange auth code and verifier for token')
 async def auth_v1_token(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
+    await __rate_limit(request, limits=('ip',))
 
     try:
-        payload = jwt.decode(token=j.get('auth_code'), key=jwt_decode_key)
+        with metric_jwt_duration.time(operation='verify'):
+            payload = jwt_signer.decode(j.get('auth_code'))
     except JWTError as e:
         return JSONr(status_code=400, content={'status': 400, 'title': 'invalid token', 'detail': str(e)})
 
     origin_ref = payload.get('origin_ref')
-    logging.info(f'> [   auth   ]: {origin_ref}: {j}')
+    await __rate_limit(request, origin_ref, limits=('origin',))
+    log_request(request, 'auth', origin_ref, '%s', j)
 
     # validate the code challenge
     challenge = b64enc(sha256(j.get('code_verifier').encode('utf-8')).digest()).rstrip(b'=').decode('utf-8')
@@ -365,12 +756,12 @@ async def auth_v1_token(request: Request):
         'kid': SITE_KEY_XID,
     }
 
-    auth_token = jwt.encode(new_payload, key=jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
+    auth_token = await __sign(new_payload, headers={'kid': payload.get('kid')})
 
     response = {
-        "expires": access_expires_on.isoformat(),
+        "expires": access_expires_on,
         "auth_token": auth_token,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
     }
 
     return JSONr(response)
@@ -379,7 +770,8 @@ async def auth_v1_token(request: Request):
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_multi_controller.py
 @app.post('/leasing/v1/lessor', description='request multiple leases (borrow) for current origin')
 async def leasing_v1_lessor(request: Request):
-    j, token, cur_time = json_loads((await request.body()).decode('utf-8')), __get_token(request), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
+    await __rate_limit(request, limits=('ip',))
 
     try:
         token = __get_token(request)
@@ -387,36 +779,59 @@ async def leasing_v1_lessor(request: Request):
         return JSONr(status_code=401, content={'status': 401, 'detail': 'token is not valid'})
 
     origin_ref = token.get('origin_ref')
+    await __rate_limit(request, origin_ref, limits=('origin',))
     scope_ref_list = j.get('scope_ref_list')
-    logging.info(f'> [  create  ]: {origin_ref}: create leases for scope_ref_list {scope_ref_list}')
+    log_request(request, 'create', origin_ref, 'create leases for scope_ref_list %s', scope_ref_list)
+    renewal_scheduler.observe()
 
-    lease_result_list = []
+    # borrowing is idempotent: an active lease of the origin for a scope is renewed and returned again, so clients
+    # which retry do not create a new lease every time
+    expires = cur_time + LEASE_EXPIRE_DELTA
+    leases = {}  # scope_ref -> new lease (if the scope has no active lease)
     for scope_ref in scope_ref_list:
         # if scope_ref not in [ALLOTMENT_REF]:
         #     return JSONr(status_code=500, detail=f'no service instances found for scopes: ["{scope_ref}"]')
+        if scope_ref not in leases:
+            leases[scope_ref] = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), scope_ref=scope_ref, lease_created=cur_time, lease_expires=expires)
+
+    # quota slots are only taken together with the new leases, so a refused request does not hold any of them
+    active, created, scope_ref = await __db(Lease.borrow, db, origin_ref, list(leases.values()), cur_time, quota=LEASE_QUOTA)
+    if scope_ref is not None:
+        metric_requests_limited.inc(reason='quota')
+        return JSONr(status_code=409, content={'status': 409, 'detail': f'no leases available for scope_ref "{scope_ref}"'})
+    leases = {_.scope_ref: _ for _ in created}
+
+    for lease in active.values():
+        if renewal_queue is not None:
+            renewal_queue.add(origin_ref, lease.lease_ref, expires, cur_time)
+    if renewal_queue is None and len(active) > 0:
+        await __db(Lease.renew_many, db, [(origin_ref, _.lease_ref, expires, cur_time) for _ in active.values()])
+    if __index() is not None:
+        for lease in active.values():
+            __index().renew(lease.lease_ref, expires)
+        for lease in leases.values():
+            __index().put(lease.lease_ref, lease.origin_ref, lease.lease_expires)
 
-        lease_ref = str(uuid4())
-        expires = cur_time + LEASE_EXPIRE_DELTA
+    lease_result_list = []
+    for scope_ref in scope_ref_list:
+        lease = active.get(scope_ref) or leases.get(scope_ref)
         lease_result_list.append({
             "ordinal": 0,
             # https://docs.nvidia.com/license-system/latest/nvidia-license-system-user-guide/index.html
             "lease": {
-                "ref": lease_ref,
-                "created": cur_time.isoformat(),
-                "expires": expires.isoformat(),
-                "recommended_lease_renewal": LEASE_RENEWAL_PERIOD,
+                "ref": lease.lease_ref,
+                "created": lease.lease_created,
+                "expires": expires,
+                "recommended_lease_renewal": renewal_scheduler.recommended_renewal(),
                 "offline_lease": "true",
                 "license_type": "CONCURRENT_COUNTED_SINGLE"
             }
         })
 
-        data = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=expires)
-        Lease.create_or_update(db, data)
-
     response = {
         "lease_result_list": lease_result_list,
         "result_code": "SUCCESS",
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
         "prompts": None
     }
 
@@ -427,16 +842,22 @@ async def leasing_v1_lessor(request: Request):
 # venv/lib/python3.9/site-packages/nls_dal_service_instance_dls/schema/service_instance/V1_0_21__product_mapping.sql
 @app.get('/leasing/v1/lessor/leases', description='get active leases for current origin')
 async def leasing_v1_lessor_lease(request: Request):
+    await __rate_limit(request, limits=('ip',))
     token, cur_time = __get_token(request), datetime.utcnow()
 
     origin_ref = token.get('origin_ref')
+    await __rate_limit(request, origin_ref, limits=('origin',))
 
-    active_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
-    logging.info(f'> [  leases  ]: {origin_ref}: found {len(active_lease_list)} active leases')
+    if __index() is not None:
+        active_lease_list = __index().find_by_origin_ref(origin_ref, cur_time)
+    else:
+        leases = await __db(Lease.find_by_origin_ref, db, origin_ref)
+        active_lease_list = [_.lease_ref for _ in leases if _.lease_expires > cur_time]
+    log_request(request, 'leases', origin_ref, 'found %d active leases', len(active_lease_list))
 
     response = {
         "active_lease_list": active_lease_list,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
         "prompts": None
     }
 
@@ -447,51 +868,70 @@ async def leasing_v1_lessor_lease(request: Request):
 # venv/lib/python3.9/site-packages/nls_core_lease/lease_single.py
 @app.put('/leasing/v1/lease/{lease_ref}', description='renew a lease')
 async def leasing_v1_lease_renew(request: Request, lease_ref: str):
+    await __rate_limit(request, limits=('ip',))
     token, cur_time = __get_token(request), datetime.utcnow()
 
     origin_ref = token.get('origin_ref')
-    logging.info(f'> [  renew   ]: {origin_ref}: renew {lease_ref}')
+    await __rate_limit(request, origin_ref, limits=('origin',))
+    log_request(request, 'renew', origin_ref, 'renew %s', lease_ref)
+    renewal_scheduler.observe()
 
-    entity = Lease.find_by_origin_ref_and_lease_ref(db, origin_ref, lease_ref)
-    if entity is None:
+    # expired leases can not be renewed (they are deleted by the reaper anyway)
+    if __index() is not None and not __index().exists(origin_ref, lease_ref, cur_time):
         return JSONr(status_code=404, content={'status': 404, 'detail': 'requested lease not available'})
 
     expires = cur_time + LEASE_EXPIRE_DELTA
+    if renewal_queue is not None:
+        entity = None if __index() is not None else await __db(Lease.find_by_origin_ref_and_lease_ref, db, origin_ref, lease_ref)
+        if __index() is None and (entity is None or entity.lease_expires <= cur_time):
+            return JSONr(status_code=404, content={'status': 404, 'detail': 'requested lease not available'})
+        renewal_queue.add(origin_ref, lease_ref, expires, cur_time)
+    elif await __db(Lease.renew, db, origin_ref, lease_ref, expires, cur_time, now=cur_time) == 0:
+        return JSONr(status_code=404, content={'status': 404, 'detail': 'requested lease not available'})
+    if __index() is not None:
+        __index().renew(lease_ref, expires)
+
     response = {
         "lease_ref": lease_ref,
-        "expires": expires.isoformat(),
-        "recommended_lease_renewal": LEASE_RENEWAL_PERIOD,
+        "expires": expires,
+        "recommended_lease_renewal": renewal_scheduler.recommended_renewal(),
         "offline_lease": True,
         "prompts": None,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
     }
 
-    Lease.renew(db, entity, expires, cur_time)
-
     return JSONr(response)
 
 
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_single_controller.py
 @app.delete('/leasing/v1/lease/{lease_ref}', description='release (return) a lease')
 async def leasing_v1_lease_delete(request: Request, lease_ref: str):
+    await __rate_limit(request, limits=('ip',))
     token, cur_time = __get_token(request), datetime.utcnow()
 
     origin_ref = token.get('origin_ref')
-    logging.info(f'> [  return  ]: {origin_ref}: return {lease_ref}')
-
-    entity = Lease.find_by_lease_ref(db, lease_ref)
-    if entity.origin_ref != origin_ref:
-        return JSONr(status_code=403, content={'status': 403, 'detail': 'access or operation forbidden'})
-    if entity is None:
+    await __rate_limit(request, origin_ref, limits=('origin',))
+    log_request(request, 'return', origin_ref, 'return %s', lease_ref)
+
+    if __index() is not None:
+        entity_origin_ref = __index().get_origin_ref(lease_ref)
+    else:
+        entity = await __db(Lease.find_by_lease_ref, db, lease_ref)
+        entity_origin_ref = None if entity is None else entity.origin_ref
+    if entity_origin_ref is None:
         return JSONr(status_code=404, content={'status': 404, 'detail': 'requested lease not available'})
+    if entity_origin_ref != origin_ref:
+        return JSONr(status_code=403, content={'status': 403, 'detail': 'access or operation forbidden'})
 
-    if Lease.delete(db, lease_ref) == 0:
+    if await __db(Lease.delete, db, lease_ref) == 0:
         return JSONr(status_code=404, content={'status': 404, 'detail': 'lease not found'})
+    if __index() is not None:
+        __index().remove(lease_ref)
 
     response = {
         "lease_ref": lease_ref,
         "prompts": None,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
     }
 
     return JSONr(response)
@@ -500,18 +940,25 @@ async def leasing_v1_lease_delete(request: Request, lease_ref: str):
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_multi_controller.py
 @app.delete('/leasing/v1/lessor/leases', description='release all leases')
 async def leasing_v1_lessor_lease_remove(request: Request):
+    await __rate_limit(request, limits=('ip',))
     token, cur_time = __get_token(request), datetime.utcnow()
 
     origin_ref = token.get('origin_ref')
+    await __rate_limit(request, origin_ref, limits=('origin',))
 
-    released_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
-    deletions = Lease.cleanup(db, origin_ref)
-    logging.info(f'> [  remove  ]: {origin_ref}: removed {deletions} leases')
+    if __index() is not None:
+        released_lease_list = __index().find_by_origin_ref(origin_ref)
+    else:
+        released_lease_list = list(map(lambda x: x.lease_ref, await __db(Lease.find_by_origin_ref, db, origin_ref)))
+    deletions = await __db(Lease.cleanup, db, origin_ref)
+    if __index() is not None:
+        __index().remove_origin(origin_ref)
+    log_request(request, 'remove', origin_ref, 'removed %d leases', deletions)
 
     response = {
         "released_lease_list": released_lease_list,
         "release_failure_list": None,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
         "prompts": None
     }
 
@@ -520,20 +967,26 @@ async def leasing_v1_lessor_lease_remove(request: Request):
 
 @app.post('/leasing/v1/lessor/shutdown', description='shutdown all leases')
 async def leasing_v1_lessor_shutdown(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.utcnow()
+    j, cur_time = json_serializer.loads(await request.body()), datetime.utcnow()
 
-    token = j.get('token')
-    token = jwt.decode(token=token, key=jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
+    await __rate_limit(request, limits=('ip',))
+    token = __decode_token(j.get('token'))
     origin_ref = token.get('origin_ref')
+    await __rate_limit(request, origin_ref, limits=('origin',))
 
-    released_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
-    deletions = Lease.cleanup(db, origin_ref)
-    logging.info(f'> [ shutdown ]: {origin_ref}: removed {deletions} leases')
+    if __index() is not None:
+        released_lease_list = __index().find_by_origin_ref(origin_ref)
+    else:
+        released_lease_list = list(map(lambda x: x.lease_ref, await __db(Lease.find_by_origin_ref, db, origin_ref)))
+    deletions = await __db(Lease.cleanup, db, origin_ref)
+    if __index() is not None:
+        __index().remove_origin(origin_ref)
+    log_request(request, 'shutdown', origin_ref, 'removed %d leases', deletions)
 
     response = {
         "released_lease_list": released_lease_list,
         "release_failure_list": None,
-        "sync_timestamp": cur_time.isoformat(),
+        "sync_timestamp": cur_time,
         "prompts": None
     }
 
@@ -549,8 +1002,43 @@ async def app_on_startup():
     If the renewal fails, the license is {str(LEASE_RENEWAL_DELTA)} valid.
     
     Your client-token file (.tok) is valid for {str(CLIENT_TOKEN_EXPIRE_DELTA)}.
+    
+    Using "{jwt_signer.name}" backend for signing and verifying tokens and "{json_serializer.name}" for json.
     ''')
 
+    if CLUSTER:
+        logger.info('Running in cluster mode as worker "%s", per-process lease state is disabled.', worker_ref)
+
+    await __warm_index()
+    if lease_index is not None:
+        logger.info('Lease index is warmed with %d leases.', len(lease_index))
+
+    if METRICS_DIR is not None:
+        background_tasks.add(create_task(__periodic(registry.dump, interval=15)))
+    if renewal_queue is not None:
+        background_tasks.add(create_task(renewal_queue.run()))
+    if LEASE_REAPER_INTERVAL > 0:
+        background_tasks.add(create_task(__periodic(__reap_expired_leases, interval=LEASE_REAPER_INTERVAL)))
+    if node_health is not None:
+        background_tasks.add(create_task(__periodic(__probe_nodes, interval=HA_HEALTH_INTERVAL)))
+    if RATE_LIMIT_SHARED and any(_ is not None for _ in rate_limits.values()):
+        background_tasks.add(create_task(__periodic(__delete_idle_rate_limits, interval=60)))
+
+
+@app.on_event('shutdown')
+async def app_on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    # wait until cancelled, so a batch of renewals which was being flushed is pending again before the final flush
+    await gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if renewal_queue is not None:
+        logger.info('Flushing %d pending lease renewals.', len(renewal_queue))
+        await renewal_queue.flush()
+    if LEASE_REAPER_INTERVAL > 0:
+        await __db(Lock.release, db, 'lease_reaper', worker_ref)  # a restarted worker can take over immediately
+    registry.remove()
+
 
 if __name__ == '__main__':
     import uvicorn
@@ -563,7 +1051,7 @@ if __name__ == '__main__':
     #
     ###
 
-    logging.info(f'> Starting dev-server ...')
+    logger.info('> Starting dev-server ...')
 
     ssl_keyfile = join(dirname(__file__), 'cert/webserver.key')
     ssl_certfile = join(dirname(__file__), 'cert/webserver.crt')
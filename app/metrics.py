@@ -0,0 +1,202 @@
+"""
+Minimal prometheus metrics (text exposition format 0.0.4) without additional dependencies.
+
+Metrics are only updated from the event-loop (blocking work measures its duration in its thread and reports it
+back), so no locks are needed. With multiple workers every worker dumps its counters and histograms to a shared
+directory and the worker answering the scrape merges them. Dumps are removed when a worker shuts down, dumps of
+workers which died without shutting down are removed once they are stale.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from glob import glob
+from json import dumps as json_dumps, loads as json_loads
+from os import getpid, replace, remove
+from os.path import join, getmtime
+from time import perf_counter, time
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: (str,), values: (str,), le: float = None) -> str:
+    x = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if le is not None:
+        x.append(f'le="{"+Inf" if le == float("inf") else le}"')
+    return '{' + ','.join(x) + '}' if len(x) > 0 else ''
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: (str,) = (), shared: bool = True):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self.shared = shared  # shared metrics are summed up over all workers, others are only exposed by the scraped one
+        self.samples = {}  # label values -> value
+
+    def _key(self, labels: dict) -> (str,):
+        return tuple(str(labels.get(_, '')) for _ in self.labels)
+
+    @abstractmethod
+    def _expose(self, samples: dict) -> [str]:
+        pass
+
+    def expose(self, samples: dict = None) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._expose(self.samples if samples is None else samples))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+    def _expose(self, samples: dict) -> [str]:
+        return [f'{self.name}{_labels(self.labels, k)} {float(v)}' for k, v in samples.items()]
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.samples[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: (str,) = (), buckets: (float,) = LATENCY_BUCKETS, shared: bool = True):
+        super().__init__(name, documentation, labels, shared)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        sample = self.samples.get(key)
+        if sample is None:
+            sample = self.samples[key] = [0] * (len(self.buckets) + 2)  # bucket counts (not cumulative), sum, count
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[i] += 1
+                break
+        sample[-2] += value
+        sample[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _expose(self, samples: dict) -> [str]:
+        lines = []
+        for k, sample in samples.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, sample):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labels, k, le=bound)} {float(cumulative)}')
+            lines.append(f'{self.name}_bucket{_labels(self.labels, k, le=float("inf"))} {float(sample[-1])}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, k)} {float(sample[-2])}')
+            lines.append(f'{self.name}_count{_labels(self.labels, k)} {float(sample[-1])}')
+        return lines
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+
+class Registry:
+    def __init__(self, directory: str = None, identity: str = None, stale_after: float = 60):
+        self.directory = directory  # shared directory for multi-worker aggregation, "None" for single process
+        self.identity = str(getpid()) if identity is None else identity
+        self.stale_after = stale_after  # seconds, dumps not updated for this long are from dead workers
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def dump(self):
+        """writes shared metrics of this worker, so other workers can merge them on scrape"""
+        if self.directory is None:
+            return
+        x = {m.name: [[list(k), v] for k, v in m.samples.items()] for m in self.metrics.values() if m.shared}
+        filename = join(self.directory, f'metrics_{self.identity}.json')
+        with open(f'{filename}.tmp', 'w') as file:
+            file.write(json_dumps(x))
+        replace(f'{filename}.tmp', filename)  # atomic, readers never see partial files
+
+    def remove(self):
+        """removes the dump of this worker (on shutdown), so its metrics are no longer merged by other workers"""
+        if self.directory is None:
+            return
+        try:
+            remove(join(self.directory, f'metrics_{self.identity}.json'))
+        except FileNotFoundError:
+            pass
+
+    def collect(self) -> dict:
+        """returns samples of all metrics, merged over all workers if a directory is configured"""
+        if self.directory is None:
+            return {m.name: m.samples for m in self.metrics.values()}
+
+        self.dump()
+        samples = {m.name: {} if m.shared else m.samples for m in self.metrics.values()}
+        for filename in glob(join(self.directory, 'metrics_*.json')):
+            try:
+                if getmtime(filename) < time() - self.stale_after:
+                    remove(filename)  # dead worker
+                    continue
+                with open(filename) as file:
+                    x = json_loads(file.read())
+            except (OSError, ValueError):
+                continue
+            for name, values in x.items():
+                metric = self.metrics.get(name)
+                if metric is None or not metric.shared:
+                    continue
+                for k, v in values:
+                    k = tuple(k)
+                    samples[name][k] = v if k not in samples[name] else metric.merge(samples[name][k], v)
+        return samples
+
+    def expose(self) -> str:
+        samples = self.collect()
+        return '\n'.join(m.expose(samples.get(m.name)) for m in self.metrics.values()) + '\n'
+
+
+class MetricsMiddleware:
+    """pure asgi middleware (no extra task or response buffering like "BaseHTTPMiddleware") for request metrics"""
+
+    def __init__(self, app, requests: Counter, latency: Histogram):
+        self.app, self.requests, self.latency = app, requests, latency
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status, start = 500, perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')  # set by fastapi's router, path template keeps the label cardinality low
+            route = route.path if route is not None else 'unmatched'
+            self.latency.observe(perf_counter() - start, method=scope['method'], route=route)
+            self.requests.inc(method=scope['method'], route=route, status=status)
@@ -1,17 +1,82 @@
+import logging
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 
-from sqlalchemy import Column, VARCHAR, CHAR, ForeignKey, DATETIME, update, and_, inspect, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import Column, VARCHAR, CHAR, INTEGER, Double, ForeignKey, DATETIME, insert, update, delete, and_, or_, inspect, text, event, func, case, bindparam
+from sqlalchemy import Index, MetaData, create_engine as sqlalchemy_create_engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, DBAPIError
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 Base = declarative_base()
+logger = logging.getLogger(__name__)
+
+
+def create_engine(url: str, pool_size: int = 5, max_overflow: int = 10, pool_recycle: int = -1, pool_pre_ping: bool = False,
+                  sqlite_wal: bool = False, sqlite_check_same_thread: bool = False) -> Engine:
+    url = make_url(url)
+    options, connect_args = dict(pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping), dict()
+
+    if url.get_backend_name() == 'sqlite':
+        # connections are handed over between threads (see "DATABASE_WORKERS"), so this check is disabled by default
+        connect_args['check_same_thread'] = sqlite_check_same_thread
+        if url.database in (None, '', ':memory:'):
+            # in-memory databases use a "SingletonThreadPool" which has no size or overflow
+            return sqlalchemy_create_engine(url, connect_args=connect_args, **options)
+
+    engine = sqlalchemy_create_engine(url, pool_size=pool_size, max_overflow=max_overflow, connect_args=connect_args, **options)
+
+    if url.get_backend_name() == 'sqlite' and sqlite_wal:
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            # write-ahead-log allows readers while a write is in progress
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+
+    return engine
+
+
+def upsert_statement(engine: Engine, table, values: dict, index_elements: [str], update_columns: [str]):
+    """
+    Returns a native "insert or update" statement for the engine's dialect, which needs only a single round-trip
+    and is atomic, so concurrent workers can not race on the same primary-key.
+    Returns "None" if the dialect has no native upsert (caller has to fall back to select, then insert or update).
+    """
+    dialect = engine.dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(**values)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in update_columns},
+        )
+
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table).values(**values)
+        return statement.on_duplicate_key_update({column: statement.inserted[column] for column in update_columns})
+
+    return None
+
+
+@lru_cache(maxsize=None)
+def session_factory(engine: Engine) -> sessionmaker:
+    # one factory per engine for the whole process, sessions are cheap but factories are not
+    return sessionmaker(bind=engine, expire_on_commit=False)
 
 
 class Origin(Base):
     __tablename__ = "origin"
 
-    origin_ref = Column(CHAR(length=36), primary_key=True, unique=True, index=True)  # uuid4
+    origin_ref = Column(CHAR(length=36), primary_key=True)  # uuid4
 
     # service_instance_xid = Column(CHAR(length=36), nullable=False, index=True)  # uuid4 # not necessary, we only support one service_instance_xid ('INSTANCE_REF')
     hostname = Column(VARCHAR(length=256), nullable=True)
@@ -39,43 +104,83 @@ class Origin(Base):
 
     @staticmethod
     def create_or_update(engine: Engine, origin: "Origin"):
-        session = sessionmaker(bind=engine)()
-        entity = session.query(Origin).filter(Origin.origin_ref == origin.origin_ref).first()
-        if entity is None:
-            session.add(origin)
-        else:
-            x = dict(
-                hostname=origin.hostname,
-                guest_driver_version=origin.guest_driver_version,
-                os_platform=origin.os_platform,
-                os_version=origin.os_version
-            )
-            session.execute(update(Origin).where(Origin.origin_ref == origin.origin_ref).values(**x))
-        session.commit()
-        session.flush()
-        session.close()
+        x = dict(
+            origin_ref=origin.origin_ref,
+            hostname=origin.hostname,
+            guest_driver_version=origin.guest_driver_version,
+            os_platform=origin.os_platform,
+            os_version=origin.os_version
+        )
+        statement = upsert_statement(engine, Origin.__table__, x, ['origin_ref'], [_ for _ in x.keys() if _ != 'origin_ref'])
+
+        with session_factory(engine)() as session:
+            if statement is not None:
+                session.execute(statement)
+                session.commit()
+                return
+
+            entity = session.query(Origin).filter(Origin.origin_ref == origin.origin_ref).first()
+            if entity is None:
+                session.add(origin)
+            else:
+                x.pop('origin_ref')
+                session.execute(update(Origin).where(Origin.origin_ref == origin.origin_ref).values(**x))
+            session.commit()
 
     @staticmethod
-    def delete(engine: Engine, origin_refs: [str] = None) -> int:
-        session = sessionmaker(bind=engine)()
-        if origin_refs is None:
-            deletions = session.query(Origin).delete()
-        else:
-            deletions = session.query(Origin).filter(Origin.origin_ref in origin_refs).delete()
-        session.commit()
-        session.close()
-        return deletions
+    def find_page(engine: Engine, after: str = None, limit: int = 1000, with_leases: bool = False) -> [("Origin", ["Lease"])]:
+        """
+        returns up to "limit" origins ordered by "origin_ref" after the "after" cursor (keyset pagination), optionally
+        with their leases, which are fetched with one query for the whole page
+        """
+        with session_factory(engine)() as session:
+            query = session.query(Origin)
+            if after is not None:
+                query = query.filter(Origin.origin_ref > after)
+            origins = query.order_by(Origin.origin_ref).limit(limit).all()
+
+            leases = {_.origin_ref: [] for _ in origins}
+            if with_leases and len(origins) > 0:
+                query = session.query(Lease).filter(Lease.origin_ref.in_(leases.keys())).order_by(Lease.lease_ref)
+                for lease in query:
+                    leases[lease.origin_ref].append(lease)
+        return [(_, leases[_.origin_ref]) for _ in origins]
+
+    @staticmethod
+    def delete(engine: Engine, origin_refs: [str] = None) -> [str]:
+        """deletes the given (or all) origins with their leases, returns the refs of the deleted origins"""
+        with session_factory(engine)() as session:
+            if origin_refs is None:
+                origin_refs = [_ for _, in session.query(Origin.origin_ref)]
+            else:
+                existing = session.query(Origin.origin_ref).filter(Origin.origin_ref.in_(origin_refs))
+                origin_refs = [_ for _, in existing]
+            if len(origin_refs) > 0:
+                session.query(Origin).filter(Origin.origin_ref.in_(origin_refs)).delete(synchronize_session=False)
+            session.commit()
+        return origin_refs
+
+    @staticmethod
+    def count(engine: Engine) -> int:
+        with session_factory(engine)() as session:
+            return session.query(func.count(Origin.origin_ref)).scalar()
 
 
 class Lease(Base):
     __tablename__ = "lease"
+    __table_args__ = (
+        # leases of an origin (also used by the foreign-key) and its active leases, without reading expired ones
+        Index('ix_lease_origin_ref_lease_expires', 'origin_ref', 'lease_expires'),
+        # latest create or renewal, for "state"
+        Index('ix_lease_lease_updated', 'lease_updated'),
+    )
 
-    lease_ref = Column(CHAR(length=36), primary_key=True, nullable=False, index=True)  # uuid4
+    lease_ref = Column(CHAR(length=36), primary_key=True, nullable=False)  # uuid4
 
-    origin_ref = Column(CHAR(length=36), ForeignKey(Origin.origin_ref, ondelete='CASCADE'), nullable=False, index=True)  # uuid4
-    # scope_ref = Column(CHAR(length=36), nullable=False, index=True)  # uuid4 # not necessary, we only support one scope_ref ('ALLOTMENT_REF')
+    origin_ref = Column(CHAR(length=36), ForeignKey(Origin.origin_ref, ondelete='CASCADE'), nullable=False)  # uuid4
+    scope_ref = Column(CHAR(length=36), nullable=True)  # uuid4, "None" for leases created before schema version 3
     lease_created = Column(DATETIME(), nullable=False)
-    lease_expires = Column(DATETIME(), nullable=False)
+    lease_expires = Column(DATETIME(), nullable=False, index=True)
     lease_updated = Column(DATETIME(), nullable=False)
 
     def __repr__(self):
@@ -88,11 +193,11 @@ class Lease(Base):
         return {
             'lease_ref': self.lease_ref,
             'origin_ref': self.origin_ref,
-            # 'scope_ref': self.scope_ref,
-            'lease_created': self.lease_created.isoformat(),
-            'lease_expires': self.lease_expires.isoformat(),
-            'lease_updated': self.lease_updated.isoformat(),
-            'lease_renewal': lease_renewal.isoformat(),
+            'scope_ref': self.scope_ref,
+            'lease_created': self.lease_created,
+            'lease_expires': self.lease_expires,
+            'lease_updated': self.lease_updated,
+            'lease_renewal': lease_renewal,
         }
 
     @staticmethod
@@ -102,71 +207,229 @@ class Lease(Base):
 
     @staticmethod
     def create_or_update(engine: Engine, lease: "Lease"):
-        session = sessionmaker(bind=engine)()
-        entity = session.query(Lease).filter(Lease.lease_ref == lease.lease_ref).first()
-        if entity is None:
-            if lease.lease_updated is None:
-                lease.lease_updated = lease.lease_created
-            session.add(lease)
-        else:
-            x = dict(origin_ref=lease.origin_ref, lease_expires=lease.lease_expires, lease_updated=lease.lease_updated)
-            session.execute(update(Lease).where(Lease.lease_ref == lease.lease_ref).values(**x))
-        session.commit()
-        session.flush()
-        session.close()
+        x = dict(
+            lease_ref=lease.lease_ref,
+            origin_ref=lease.origin_ref,
+            scope_ref=lease.scope_ref,
+            lease_created=lease.lease_created,
+            lease_expires=lease.lease_expires,
+            lease_updated=lease.lease_created if lease.lease_updated is None else lease.lease_updated,
+        )
+        statement = upsert_statement(engine, Lease.__table__, x, ['lease_ref'], ['origin_ref', 'lease_expires', 'lease_updated'])
+
+        with session_factory(engine)() as session:
+            if statement is not None:
+                session.execute(statement)
+                session.commit()
+                return
+
+            entity = session.query(Lease).filter(Lease.lease_ref == lease.lease_ref).first()
+            if entity is None:
+                session.add(Lease(**x))
+            else:
+                x = dict(origin_ref=x['origin_ref'], lease_expires=x['lease_expires'], lease_updated=x['lease_updated'])
+                session.execute(update(Lease).where(Lease.lease_ref == lease.lease_ref).values(**x))
+            session.commit()
+
+    @staticmethod
+    def create_many(engine: Engine, leases: ["Lease"]) -> int:
+        """inserts all leases with a single multi-row insert in one transaction, so either all or none are created"""
+        if len(leases) == 0:
+            return 0
+
+        with session_factory(engine)() as session:
+            session.execute(Lease.insert_statement(leases))
+            session.commit()
+        return len(leases)
+
+    @staticmethod
+    def insert_statement(leases: ["Lease"]):
+        """single multi-row insert of all leases"""
+        return insert(Lease).values([dict(
+            lease_ref=lease.lease_ref,
+            origin_ref=lease.origin_ref,
+            scope_ref=lease.scope_ref,
+            lease_created=lease.lease_created,
+            lease_expires=lease.lease_expires,
+            lease_updated=lease.lease_created if lease.lease_updated is None else lease.lease_updated,
+        ) for lease in leases])
+
+    @staticmethod
+    def find_page(engine: Engine, after: str = None, limit: int = 1000, with_origin: bool = False) -> [("Lease", "Origin")]:
+        """
+        returns up to "limit" leases ordered by "lease_ref" after the "after" cursor (keyset pagination), optionally
+        joined with their origin (which is "None" if not joined or not found)
+        """
+        with session_factory(engine)() as session:
+            if with_origin:
+                query = session.query(Lease, Origin).outerjoin(Origin, Origin.origin_ref == Lease.origin_ref)
+            else:
+                query = session.query(Lease)
+            if after is not None:
+                query = query.filter(Lease.lease_ref > after)
+            rows = query.order_by(Lease.lease_ref).limit(limit).all()
+        return [tuple(_) for _ in rows] if with_origin else [(_, None) for _ in rows]
 
     @staticmethod
     def find_by_origin_ref(engine: Engine, origin_ref: str) -> ["Lease"]:
-        session = sessionmaker(bind=engine)()
-        entities = session.query(Lease).filter(Lease.origin_ref == origin_ref).all()
-        session.close()
-        return entities
+        with session_factory(engine)() as session:
+            return session.query(Lease).filter(Lease.origin_ref == origin_ref).all()
 
     @staticmethod
     def find_by_lease_ref(engine: Engine, lease_ref: str) -> "Lease":
-        session = sessionmaker(bind=engine)()
-        entity = session.query(Lease).filter(Lease.lease_ref == lease_ref).first()
-        session.close()
-        return entity
+        with session_factory(engine)() as session:
+            return session.query(Lease).filter(Lease.lease_ref == lease_ref).first()
+
+    @staticmethod
+    def find_active_by_origin_ref_and_scope_refs(engine: Engine, origin_ref: str, scope_refs: [str], now: datetime) -> {str: "Lease"}:
+        """returns the active lease (the one expiring last, if there are multiple) of the origin per scope_ref"""
+        with session_factory(engine)() as session:
+            return Lease.__find_active(session, origin_ref, scope_refs, now)
+
+    @staticmethod
+    def __find_active(session, origin_ref: str, scope_refs: [str], now: datetime) -> {str: "Lease"}:
+        leases = session.query(Lease) \
+            .filter(and_(Lease.origin_ref == origin_ref, Lease.scope_ref.in_(set(scope_refs)), Lease.lease_expires > now)) \
+            .order_by(Lease.lease_expires).all()
+        return {_.scope_ref: _ for _ in leases}
+
+    @staticmethod
+    def borrow(engine: Engine, origin_ref: str, leases: ["Lease"], now: datetime, quota: int = 0,
+               recount_after: timedelta = timedelta(seconds=5)) -> ({str: "Lease"}, ["Lease"], str):
+        """
+        Borrowing is idempotent: of "leases" (one per scope_ref) only those are inserted whose scope has no active lease
+        of the origin yet, and only if the "quota" (if any) of all their scopes allows it. The origin is locked for the
+        lookup and the insert, so concurrent (e.g. retried) requests of an origin can not both insert a lease for a scope.
+        Returns the active leases per scope_ref, the inserted leases and the scope_ref whose quota is reached (if any).
+        """
+        scope_refs = list({_.scope_ref for _ in leases})
+        if quota > 0:
+            LeaseQuota._create_missing(engine, scope_refs, now)
+
+        with session_factory(engine)() as session:
+            # a (no-op) write locks the origin on every database, sqlite does not support "SELECT ... FOR UPDATE"
+            session.execute(update(Origin).where(Origin.origin_ref == origin_ref).values(hostname=Origin.hostname))
+            active = Lease.__find_active(session, origin_ref, scope_refs, now)
+            leases = [_ for _ in leases if _.scope_ref not in active]
+            if quota > 0 and len(leases) > 0:
+                scope_ref = LeaseQuota._acquire(session, leases, quota, now, recount_after)
+                if scope_ref is not None:
+                    session.rollback()
+                    return active, [], scope_ref
+            if len(leases) > 0:
+                session.execute(Lease.insert_statement(leases))
+            session.commit()
+        return active, leases, None
 
     @staticmethod
     def find_by_origin_ref_and_lease_ref(engine: Engine, origin_ref: str, lease_ref: str) -> "Lease":
-        session = sessionmaker(bind=engine)()
-        entity = session.query(Lease).filter(and_(Lease.origin_ref == origin_ref, Lease.lease_ref == lease_ref)).first()
-        session.close()
-        return entity
+        with session_factory(engine)() as session:
+            return session.query(Lease).filter(and_(Lease.origin_ref == origin_ref, Lease.lease_ref == lease_ref)).first()
+
+    @staticmethod
+    def find_refs(engine: Engine) -> [(str, str, datetime)]:
+        """returns (lease_ref, origin_ref, lease_expires) of all leases, without loading full entities"""
+        with session_factory(engine)() as session:
+            return [tuple(_) for _ in session.query(Lease.lease_ref, Lease.origin_ref, Lease.lease_expires)]
+
+    @staticmethod
+    def renew(engine: Engine, origin_ref: str, lease_ref: str, lease_expires: datetime, lease_updated: datetime, now: datetime = None) -> int:
+        """
+        renews the lease with a single update, returns the number of updated rows (0 if the lease does not exist, or
+        if "now" is given and it is expired)
+        """
+        with session_factory(engine)() as session:
+            x = dict(lease_expires=lease_expires, lease_updated=lease_updated)
+            condition = and_(Lease.origin_ref == origin_ref, Lease.lease_ref == lease_ref)
+            if now is not None:
+                condition = and_(condition, Lease.lease_expires > now)
+            result = session.execute(update(Lease).where(condition).values(**x))
+            session.commit()
+        return result.rowcount
 
     @staticmethod
-    def renew(engine: Engine, lease: "Lease", lease_expires: datetime, lease_updated: datetime):
-        session = sessionmaker(bind=engine)()
-        x = dict(lease_expires=lease_expires, lease_updated=lease_updated)
-        session.execute(update(Lease).where(and_(Lease.origin_ref == lease.origin_ref, Lease.lease_ref == lease.lease_ref)).values(**x))
-        session.commit()
-        session.close()
+    def renew_many(engine: Engine, renewals: [(str, str, datetime, datetime)]) -> int:
+        """renews multiple (origin_ref, lease_ref, lease_expires, lease_updated) in one transaction"""
+        if len(renewals) == 0:
+            return 0
+
+        statement = update(Lease.__table__).where(and_(
+            Lease.__table__.c.origin_ref == bindparam('b_origin_ref'),
+            Lease.__table__.c.lease_ref == bindparam('b_lease_ref'),
+        )).values(lease_expires=bindparam('b_lease_expires'), lease_updated=bindparam('b_lease_updated'))
+        x = [dict(b_origin_ref=_[0], b_lease_ref=_[1], b_lease_expires=_[2], b_lease_updated=_[3]) for _ in renewals]
+
+        with session_factory(engine)() as session:
+            result = session.connection().execute(statement, x)
+            session.commit()
+        return result.rowcount
 
     @staticmethod
     def cleanup(engine: Engine, origin_ref: str) -> int:
-        session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.origin_ref == origin_ref).delete()
-        session.commit()
-        session.close()
+        with session_factory(engine)() as session:
+            deletions = session.query(Lease).filter(Lease.origin_ref == origin_ref).delete()
+            session.commit()
         return deletions
 
     @staticmethod
     def delete(engine: Engine, lease_ref: str) -> int:
-        session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.lease_ref == lease_ref).delete()
-        session.commit()
-        session.close()
+        with session_factory(engine)() as session:
+            deletions = session.query(Lease).filter(Lease.lease_ref == lease_ref).delete()
+            session.commit()
         return deletions
 
     @staticmethod
-    def delete_expired(engine: Engine) -> int:
-        session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.lease_expires <= datetime.utcnow()).delete()
-        session.commit()
-        session.close()
-        return deletions
+    def delete_expired(engine: Engine, chunk_size: int = 500) -> [str]:
+        """deletes all expired leases in chunks, returns their refs"""
+        deletions, expires_before = [], datetime.utcnow()
+        while True:
+            lease_refs = Lease.delete_expired_chunk(engine, expires_before, chunk_size)
+            deletions.extend(lease_refs)
+            if len(lease_refs) < chunk_size:
+                return deletions
+
+    @staticmethod
+    def delete_expired_chunk(engine: Engine, expires_before: datetime, limit: int) -> [str]:
+        """
+        Deletes up to "limit" leases expired before "expires_before" in a short transaction and returns their refs.
+        Refs are selected first (using the "lease_expires" index), because MySQL does not support "LIMIT" in subqueries.
+        """
+        with session_factory(engine)() as session:
+            lease_refs = session.query(Lease.lease_ref) \
+                .filter(Lease.lease_expires <= expires_before) \
+                .order_by(Lease.lease_expires) \
+                .limit(limit).all()
+            lease_refs = [_.lease_ref for _ in lease_refs]
+            if len(lease_refs) == 0:
+                return []
+
+            # a lease may have been renewed since it was selected, so "lease_expires" is checked again
+            expired = and_(Lease.lease_ref.in_(lease_refs), Lease.lease_expires <= expires_before)
+            deletions = session.query(Lease).filter(expired).delete(synchronize_session=False)
+            if deletions < len(lease_refs):
+                renewed = session.query(Lease.lease_ref).filter(Lease.lease_ref.in_(lease_refs)).all()
+                renewed = set(_.lease_ref for _ in renewed)
+                lease_refs = [_ for _ in lease_refs if _ not in renewed]
+            session.commit()
+        return lease_refs
+
+    @staticmethod
+    def state(engine: Engine) -> (int, datetime):
+        """cheap fingerprint of the table, which changes on every create, renewal and delete (e.g. for etags)"""
+        # "lease_updated" is set on create too. Separate subqueries, so "max" only reads the end of its index
+        with session_factory(engine)() as session:
+            count = session.query(func.count(Lease.lease_ref)).scalar_subquery()
+            updated = session.query(func.max(Lease.lease_updated)).scalar_subquery()
+            x = session.query(count, updated).one()
+        return tuple(x)
+
+    @staticmethod
+    def count_active(engine: Engine, expiring_before: datetime) -> (int, int):
+        """returns the number of active leases and how many of them expire before "expiring_before" in one query"""
+        with session_factory(engine)() as session:
+            expiring = func.sum(case((Lease.lease_expires <= expiring_before, 1), else_=0))
+            active, expiring = session.query(func.count(), expiring).filter(Lease.lease_expires > datetime.utcnow()).one()
+        return active, expiring or 0
 
     @staticmethod
     def calculate_renewal(renewal_period: float, delta: timedelta) -> timedelta:
@@ -191,38 +454,401 @@ class Lease(Base):
         return renew
 
 
-def init(engine: Engine):
-    tables = [Origin, Lease]
-    db = inspect(engine)
-    session = sessionmaker(bind=engine)()
-    for table in tables:
-        if not db.dialect.has_table(engine.connect(), table.__tablename__):
-            session.execute(text(str(table.create_statement(engine))))
+class LeaseQuota(Base):
+    """
+    Number of leases per scope (allotment), so a quota can be enforced with a single conditional update instead of
+    counting the leases on every request. Slots are taken in the same transaction that inserts the leases (see
+    "Lease.borrow"), so they are either both committed or both rolled back. Returned and expired leases are not
+    subtracted, instead the active leases are recounted when the quota is reached (at most every "recount_after"),
+    which frees their slots.
+    """
+
+    __tablename__ = "lease_quota"
+
+    scope_ref = Column(CHAR(length=36), primary_key=True, nullable=False)  # uuid4
+    leases = Column(INTEGER(), nullable=False)
+    counted = Column(DATETIME(), nullable=False)  # last recount of active leases
+
+    def __repr__(self):
+        return f'LeaseQuota(scope_ref={self.scope_ref}, leases={self.leases}, counted={self.counted})'
+
+    @staticmethod
+    def create_statement(engine: Engine):
+        from sqlalchemy.schema import CreateTable
+        return CreateTable(LeaseQuota.__table__).compile(engine)
+
+    @staticmethod
+    def _create_missing(engine: Engine, scope_refs: [str], now: datetime):
+        """creates the counters of new scopes with their active leases, each in its own transaction"""
+        with session_factory(engine)() as session:
+            existing = {_ for _, in session.query(LeaseQuota.scope_ref).filter(LeaseQuota.scope_ref.in_(scope_refs))}
+        for scope_ref in scope_refs:
+            if scope_ref in existing:
+                continue
+            with session_factory(engine)() as session:
+                try:
+                    active = session.query(func.count(Lease.lease_ref)).filter(and_(Lease.scope_ref == scope_ref, Lease.lease_expires > now)).scalar()
+                    session.execute(insert(LeaseQuota).values(scope_ref=scope_ref, leases=active, counted=now))
+                    session.commit()
+                except IntegrityError:  # created by another worker meanwhile
+                    session.rollback()
+
+    @staticmethod
+    def _acquire(session, leases: ["Lease"], quota: int, now: datetime, recount_after: timedelta) -> str:
+        """
+        takes the slots of "leases" in the transaction of "session", which must insert them too. Returns the first
+        scope_ref whose quota is reached (then the transaction must be rolled back), or None.
+        """
+        counts = {}
+        for lease in leases:
+            counts[lease.scope_ref] = counts.get(lease.scope_ref, 0) + 1
+        for scope_ref in sorted(counts.keys()):  # same order in every worker, so they can not deadlock
+            if not LeaseQuota.__acquire(session, scope_ref, counts[scope_ref], quota, now, recount_after):
+                return scope_ref
+        return None
+
+    @staticmethod
+    def __acquire(session, scope_ref: str, count: int, quota: int, now: datetime, recount_after: timedelta) -> bool:
+        available = and_(LeaseQuota.scope_ref == scope_ref, LeaseQuota.leases + count <= quota)
+        if session.execute(update(LeaseQuota).where(available).values(leases=LeaseQuota.leases + count)).rowcount == 1:
+            return True
+
+        # the counter is locked until this transaction ends, and as slots are only taken together with their leases,
+        # leases of all slots taken by other workers are committed (and counted) once the lock is granted
+        entity = session.query(LeaseQuota).filter(LeaseQuota.scope_ref == scope_ref).with_for_update().one()
+        if entity.counted > now - recount_after:
+            return False  # recounted recently, so the quota is really reached
+
+        active = session.query(func.count(Lease.lease_ref)).filter(and_(Lease.scope_ref == scope_ref, Lease.lease_expires > now)).scalar()
+        acquired = active + count <= quota
+        entity.leases, entity.counted = active + count if acquired else active, now
+        session.flush()
+        return acquired
+
+
+class Lock(Base):
+    """named lock with expiry, used to elect a single worker (e.g. for periodic tasks) if multiple workers are running"""
+
+    __tablename__ = "lock"
+
+    name = Column(VARCHAR(length=64), primary_key=True, nullable=False)
+    holder = Column(CHAR(length=36), nullable=False)  # uuid4
+    expires = Column(DATETIME(), nullable=False)
+
+    def __repr__(self):
+        return f'Lock(name={self.name}, holder={self.holder}, expires={self.expires})'
+
+    @staticmethod
+    def create_statement(engine: Engine):
+        from sqlalchemy.schema import CreateTable
+        return CreateTable(Lock.__table__).compile(engine)
+
+    @staticmethod
+    def acquire(engine: Engine, name: str, holder: str, ttl: timedelta) -> bool:
+        """acquires or extends the lock "name" for "holder", if it is free, expired or already held by "holder" """
+        now = datetime.utcnow()
+        with session_factory(engine)() as session:
+            available = and_(Lock.name == name, or_(Lock.holder == holder, Lock.expires <= now))
+            result = session.execute(update(Lock).where(available).values(holder=holder, expires=now + ttl))
+            if result.rowcount == 0:
+                try:
+                    # either the lock does not exist yet, or it is held by someone else (then the primary-key fails)
+                    session.execute(insert(Lock).values(name=name, holder=holder, expires=now + ttl))
+                except IntegrityError:
+                    session.rollback()
+                    return False
+            session.commit()
+        return True
+
+    @staticmethod
+    def release(engine: Engine, name: str, holder: str) -> bool:
+        """releases the lock "name" (e.g. on shutdown), if it is held by "holder", so others can acquire it at once"""
+        with session_factory(engine)() as session:
+            result = session.execute(delete(Lock).where(and_(Lock.name == name, Lock.holder == holder)))
             session.commit()
-    session.close()
+        return result.rowcount == 1
+
+
+class RateLimit(Base):
+    """token bucket (see "limits.TokenBuckets") shared by all workers, for rate limits with multiple workers"""
+
+    __tablename__ = "rate_limit"
 
+    name = Column(VARCHAR(length=128), primary_key=True, nullable=False)  # e.g. "origin:<origin_ref>" or "ip:<address>"
+    tokens = Column(Double(), nullable=False)
+    updated = Column(Double(), nullable=False)  # unix timestamp, so refilling is plain arithmetic on every database
 
-def migrate(engine: Engine):
+    def __repr__(self):
+        return f'RateLimit(name={self.name}, tokens={self.tokens}, updated={self.updated})'
+
+    @staticmethod
+    def create_statement(engine: Engine):
+        from sqlalchemy.schema import CreateTable
+        return CreateTable(RateLimit.__table__).compile(engine)
+
+    @staticmethod
+    def acquire(engine: Engine, name: str, rate: float, burst: float, now: float) -> float:
+        """takes a token of bucket "name", returns 0 if one was available, otherwise the seconds until one is"""
+        available = RateLimit.tokens + (now - RateLimit.updated) * rate
+        available = case((available > burst, burst), else_=available)
+        with session_factory(engine)() as session:
+            # a single conditional update, so concurrent workers can not take the same token. "tokens" is assigned
+            # first, because mysql evaluates assignments in order (and "tokens" is calculated from the old "updated")
+            statement = update(RateLimit).where(and_(RateLimit.name == name, available >= 1))
+            result = session.execute(statement.ordered_values((RateLimit.tokens, available - 1), (RateLimit.updated, now)))
+            if result.rowcount == 1:
+                session.commit()
+                return 0
+
+            bucket = session.query(RateLimit).filter(RateLimit.name == name).first()
+            if bucket is not None:
+                return (1 - min(burst, bucket.tokens + (now - bucket.updated) * rate)) / rate
+            try:
+                session.execute(insert(RateLimit).values(name=name, tokens=burst - 1, updated=now))
+                session.commit()
+            except IntegrityError:  # created by another worker meanwhile
+                session.rollback()
+                return RateLimit.acquire(engine, name, rate, burst, now)
+        return 0
+
+    @staticmethod
+    def delete_idle(engine: Engine, updated_before: float) -> int:
+        """deletes buckets which were not used since "updated_before", they are full anyway"""
+        with session_factory(engine)() as session:
+            deletions = session.query(RateLimit).filter(RateLimit.updated < updated_before).delete()
+            session.commit()
+        return deletions
+
+
+MIGRATION_LOCK = 'fastapi-dls-migration'
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(INTEGER(), primary_key=True, nullable=False)
+
+    @staticmethod
+    def create_statement(engine: Engine):
+        from sqlalchemy.schema import CreateTable
+        return CreateTable(SchemaVersion.__table__).compile(engine)
+
+    @staticmethod
+    def get(engine: Engine) -> int:
+        """returns the current schema version, or "None" for new (or pre-versioning) databases"""
+        try:
+            with session_factory(engine)() as session:
+                return session.query(func.max(SchemaVersion.version)).scalar()
+        except DBAPIError:  # table does not exist
+            return None
+
+    @staticmethod
+    def set(engine: Engine, version: int):
+        with session_factory(engine)() as session:
+            session.query(SchemaVersion).delete()
+            session.add(SchemaVersion(version=version))
+            session.commit()
+
+
+@contextmanager
+def migration_lock(engine: Engine, timeout: int = 300):
+    """
+    Serializes "init" and "migrate" over all workers and nodes using the same database, so schema changes run once.
+    Uses advisory locks on postgres and mysql/mariadb and a lock-file next to the database file on sqlite.
+    """
+    dialect = engine.dialect.name
+
+    if dialect == 'postgresql':
+        key = int.from_bytes(MIGRATION_LOCK.encode('utf-8')[:8], 'big', signed=True)  # advisory locks use bigint keys
+        with engine.connect() as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), dict(key=key))
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), dict(key=key))
+        return
+
+    if dialect in ('mysql', 'mariadb'):
+        with engine.connect() as connection:
+            if connection.execute(text('SELECT GET_LOCK(:name, :timeout)'), dict(name=MIGRATION_LOCK, timeout=timeout)).scalar() != 1:
+                raise TimeoutError(f'could not acquire migration lock within {timeout} seconds')
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), dict(name=MIGRATION_LOCK))
+        return
+
+    database = engine.url.database if dialect == 'sqlite' else None
+    try:
+        import fcntl
+    except ModuleNotFoundError:  # not available on windows
+        fcntl = None
+    if database in (None, '', ':memory:') or fcntl is None:
+        # in-memory databases are private to this process
+        yield
+        return
+
+    with open(f'{database}.lock', 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def init(engine: Engine):
+    tables = [Origin, Lease, LeaseQuota, Lock, RateLimit, SchemaVersion]
+    db = inspect(engine)
+    with session_factory(engine)() as session:
+        for table in tables:
+            if not db.has_table(table.__tablename__):
+                session.execute(text(str(table.create_statement(engine))))
+                session.commit()
+
+
+def _create_index(engine: Engine, index):
+    """creates an index (if missing) without blocking writes to its table, which may be large"""
+    if index.name in [_['name'] for _ in inspect(engine).get_indexes(index.table.name)]:
+        return
+
+    columns = ', '.join(_.name for _ in index.columns)
+    if engine.dialect.name == 'postgresql':
+        # "concurrently" can not run inside a transaction
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text(f'CREATE INDEX CONCURRENTLY {index.name} ON {index.table.name} ({columns})'))
+    elif engine.dialect.name in ('mysql', 'mariadb'):
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE INDEX {index.name} ON {index.table.name} ({columns}) ALGORITHM=INPLACE LOCK=NONE'))
+    else:
+        index.create(bind=engine)
+
+
+def _drop_index(engine: Engine, table: str, name: str):
+    """drops an index (if it exists) without blocking writes to its table"""
+    if name not in [_['name'] for _ in inspect(engine).get_indexes(table)]:
+        return
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+    elif engine.dialect.name in ('mysql', 'mariadb'):
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP INDEX {name} ON {table} ALGORITHM=INPLACE LOCK=NONE'))
+    else:
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+
+def _migrate_lease_primary_key(engine: Engine):
+    """"lease_ref" as primary-key of "lease" instead of "origin_ref" (schema before 1.1)"""
     db = inspect(engine)
+    if 'origin_ref' not in db.get_pk_constraint(Lease.__tablename__)['constrained_columns']:
+        return
 
-    def upgrade_1_0_to_1_1():
-        x = db.dialect.get_columns(engine.connect(), Lease.__tablename__)
-        x = next(_ for _ in x if _['name'] == 'origin_ref')
-        if x['primary_key'] > 0:
-            print('Found old database schema with "origin_ref" as primary-key in "lease" table. Dropping table!')
-            print('  Your leases are recreated on next renewal!')
-            print('  If an error message appears on the client, you can ignore it.')
-            Lease.__table__.drop(bind=engine)
-            init(engine)
-
-    # def upgrade_1_2_to_1_3():
-    #    x = db.dialect.get_columns(engine.connect(), Lease.__tablename__)
-    #    x = next((_ for _ in x if _['name'] == 'scope_ref'), None)
-    #    if x is None:
-    #        Lease.scope_ref.compile()
-    #        column_name = Lease.scope_ref.name
-    #        column_type = Lease.scope_ref.type.compile(engine.dialect)
-    #        engine.execute(f'ALTER TABLE "{Lease.__tablename__}" ADD COLUMN "{column_name}" {column_type}')
-
-    upgrade_1_0_to_1_1()
-    # upgrade_1_2_to_1_3()
+    # leases are copied into a new table (instead of dropping them), so clients keep their leases
+    metadata = MetaData()
+    Origin.__table__.to_metadata(metadata)  # referenced by foreign-key
+    table = Lease.__table__.to_metadata(metadata, name=f'{Lease.__tablename__}_new')
+    existing = [_['name'] for _ in db.get_columns(Lease.__tablename__)]
+    columns = [_.name for _ in table.columns if _.name in existing or _.name == 'lease_updated']
+    values = [_ if _ in existing else 'lease_created' for _ in columns]  # "lease_updated" did not always exist
+
+    from sqlalchemy.schema import CreateTable
+    with engine.begin() as connection:
+        connection.execute(CreateTable(table))
+        connection.execute(text(f'INSERT INTO {table.name} ({", ".join(columns)}) SELECT {", ".join(values)} FROM {Lease.__tablename__}'))
+        connection.execute(text(f'DROP TABLE {Lease.__tablename__}'))
+        connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {Lease.__tablename__}'))
+
+
+def _migrate_lease_expires_index(engine: Engine):
+    """index on "lease_expires" for the expired-leases reaper"""
+    _create_index(engine, next(_ for _ in Lease.__table__.indexes if _.name == 'ix_lease_lease_expires'))
+
+
+def _migrate_lease_scope_ref(engine: Engine):
+    """"scope_ref" column in "lease" """
+    if 'scope_ref' in [_['name'] for _ in inspect(engine).get_columns(Lease.__tablename__)]:
+        return
+
+    # nullable without default, so no database has to rewrite the table
+    column_type = Lease.scope_ref.type.compile(engine.dialect)
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {Lease.__tablename__} ADD COLUMN scope_ref {column_type}'))
+
+
+def _migrate_rate_limit_table(engine: Engine):
+    """"rate_limit" table for rate limits shared by all workers"""
+    if inspect(engine).has_table(RateLimit.__tablename__):  # created by "init"
+        return
+
+    with engine.begin() as connection:
+        connection.execute(text(str(RateLimit.create_statement(engine))))
+
+
+def _migrate_lease_quota_table(engine: Engine):
+    """"lease_quota" table for lease quotas per scope"""
+    if inspect(engine).has_table(LeaseQuota.__tablename__):  # created by "init"
+        return
+
+    with engine.begin() as connection:
+        connection.execute(text(str(LeaseQuota.create_statement(engine))))
+
+
+def _migrate_lease_origin_ref_expires_index(engine: Engine):
+    """index on "origin_ref" and "lease_expires" for leases of an origin"""
+    _create_index(engine, next(_ for _ in Lease.__table__.indexes if _.name == 'ix_lease_origin_ref_lease_expires'))
+
+
+def _migrate_lease_updated_index(engine: Engine):
+    """index on "lease_updated" for "Lease.state", which otherwise reads the whole table"""
+    _create_index(engine, next(_ for _ in Lease.__table__.indexes if _.name == 'ix_lease_lease_updated'))
+
+
+def _migrate_drop_redundant_indexes(engine: Engine):
+    """drops indexes duplicating primary-keys or "ix_lease_origin_ref_lease_expires", which only slow down writes"""
+    # only exist if the tables were created from the models (e.g. with "create_all"), instead of by "init"
+    for table, name in (('lease', 'ix_lease_lease_ref'), ('lease', 'ix_lease_origin_ref'), ('origin', 'ix_origin_origin_ref')):
+        _drop_index(engine, table, name)
+
+
+# ordered, the schema version is the number of applied migrations. Every migration has to check if it is required,
+# because databases created before schema versioning have no version, but may already have some of the changes.
+# Migrations must not lose data and should not block the tables for long.
+MIGRATIONS = [
+    _migrate_lease_primary_key,  # 1
+    _migrate_lease_expires_index,  # 2
+    _migrate_lease_scope_ref,  # 3
+    _migrate_rate_limit_table,  # 4
+    _migrate_lease_quota_table,  # 5
+    _migrate_lease_origin_ref_expires_index,  # 6
+    _migrate_drop_redundant_indexes,  # 7, after 6, which takes over the foreign-key index on mysql
+    _migrate_lease_updated_index,  # 8
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(engine: Engine, version: int = 0) -> int:
+    """applies all migrations after schema version "version" in order and returns the new schema version"""
+    for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info('Migrating database schema to version %d: %s', i, migration.__doc__)
+        migration(engine)
+        SchemaVersion.set(engine, i)  # a failed migration resumes here on next start
+    return SCHEMA_VERSION
+
+
+def upgrade(engine: Engine) -> bool:
+    """
+    Runs "init" and "migrate" once over all workers, unless the schema is already current. This is checked with a
+    single query, so restarts with an up-to-date schema do not inspect the database. Returns if anything was done.
+    """
+    if (SchemaVersion.get(engine) or 0) >= SCHEMA_VERSION:
+        return False
+
+    with migration_lock(engine):
+        version = SchemaVersion.get(engine) or 0
+        if version >= SCHEMA_VERSION:  # another worker was faster
+            return False
+        init(engine)
+        migrate(engine, version)
+    return True
@@ -0,0 +1,108 @@
+import logging
+from asyncio import Event, wait_for, TimeoutError
+from datetime import datetime
+from random import random
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class RenewalQueue:
+    """
+    Write-behind queue for lease renewals.
+
+    Renewals are collected (multiple renewals of the same lease are coalesced, the latest wins) and written in one
+    transaction every "window" seconds or as soon as "batch_size" leases are pending. If the process crashes, at most
+    the renewals of the last "window" seconds are lost, which only means those leases expire a bit earlier.
+    Only used from the event-loop, so no locks are needed.
+    """
+
+    def __init__(self, flush, window: float, batch_size: int):
+        self.__flush = flush  # async callable, which gets a list of (origin_ref, lease_ref, lease_expires, lease_updated)
+        self.window, self.batch_size = window, batch_size
+        self.__pending = {}  # lease_ref -> (origin_ref, lease_ref, lease_expires, lease_updated)
+        self.__full = Event()
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def add(self, origin_ref: str, lease_ref: str, lease_expires: datetime, lease_updated: datetime):
+        self.__pending[lease_ref] = (origin_ref, lease_ref, lease_expires, lease_updated)
+        if len(self.__pending) >= self.batch_size:
+            self.__full.set()
+
+    async def flush(self) -> int:
+        if len(self.__pending) == 0:
+            return 0
+
+        pending, self.__pending = self.__pending, {}
+        try:
+            await self.__flush(list(pending.values()))
+        except BaseException:
+            # keep renewals for next flush (also if cancelled, e.g. on shutdown), but do not overwrite newer ones which
+            # arrived meanwhile
+            self.__pending = {**pending, **self.__pending}
+            raise
+        return len(pending)
+
+    async def run(self):
+        """flushes every "window" seconds or when "batch_size" is reached, until the task is cancelled"""
+        while True:
+            try:
+                await wait_for(self.__full.wait(), timeout=self.window)
+            except TimeoutError:
+                pass
+            self.__full.clear()
+            try:
+                count = await self.flush()
+                if count > 0:
+                    logger.debug('flushed %d lease renewals', count)
+            except Exception as e:
+                logger.exception('flushing lease renewals failed, retrying in %s seconds: %s', self.window, e)
+
+
+class RenewalScheduler:
+    """
+    Spreads lease renewals over time, so clients which were started at the same time do not renew in lockstep.
+
+    Every response gets its own "recommended_lease_renewal", randomly chosen within "period" +/- "jitter" (relative to
+    "period", at most 50%). If "target_rate" (renewals per second) is set and the current rate of renewals is above the
+    target, renewals are only spread later (e.g. twice the target rate spreads up to twice the period), so the next
+    renewals of a burst are spread wider without recommending earlier ones, which would only add load. As clients must
+    renew before their lease expires, renewals are never recommended after 90% of the lease.
+    """
+
+    MAX_JITTER = 0.5  # renewals are never recommended earlier than half the period
+    MAX_STRETCH = 1.0  # or, when above the target rate, later than twice the period
+    MAX_RENEWAL = 0.9
+
+    def __init__(self, period: float, jitter: float = 0, target_rate: float = 0, window: float = 10, rand=random, clock=monotonic):
+        self.period, self.jitter, self.target_rate, self.window = period, min(jitter, self.MAX_JITTER), target_rate, window
+        self.__random, self.__clock = rand, clock
+        self.__bucket, self.__current, self.__previous = None, 0, 0  # renewals counted in fixed windows
+
+    def __roll(self, now: float):
+        bucket = int(now // self.window)
+        if bucket != self.__bucket:
+            self.__previous = self.__current if self.__bucket is not None and bucket == self.__bucket + 1 else 0
+            self.__bucket, self.__current = bucket, 0
+
+    def observe(self):
+        """counts a renewal (or new lease) for the current rate"""
+        self.__roll(self.__clock())
+        self.__current += 1
+
+    def rate(self) -> float:
+        """renewals per second, the previous window is weighted by how much of it still overlaps a sliding window"""
+        now = self.__clock()
+        self.__roll(now)
+        overlap = 1 - (now % self.window) / self.window
+        return (self.__previous * overlap + self.__current) / self.window
+
+    def recommended_renewal(self) -> float:
+        low, high = self.period * (1 - self.jitter), self.period * (1 + self.jitter)
+        if self.target_rate > 0:
+            high = max(high, self.period * (1 + min(self.MAX_STRETCH, self.rate() / self.target_rate - 1)))
+        if high <= low:
+            return self.period
+        return min(low + (high - low) * self.__random(), max(self.period, self.MAX_RENEWAL))
@@ -0,0 +1,90 @@
+from datetime import date, datetime
+from uuid import UUID
+
+from starlette.responses import JSONResponse
+
+
+class Serializer:
+    """
+    Serializes and parses json with the stdlib "json" module.
+
+    Output is compact utf-8 (like starlette's "JSONResponse"). Datetimes are serialized natively in iso format, so
+    payloads can contain datetime objects directly. Other backends produce the same output, only faster.
+    """
+
+    name = 'json'
+
+    def __init__(self):
+        from json import dumps, loads
+        self._dumps, self._loads = dumps, loads
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name})'
+
+    @staticmethod
+    def _default(o):
+        if isinstance(o, (datetime, date)):
+            return o.isoformat()
+        if isinstance(o, UUID):
+            return str(o)
+        raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+    def dumps(self, content) -> bytes:
+        return self._dumps(content, ensure_ascii=False, separators=(',', ':'), default=self._default).encode('utf-8')
+
+    def loads(self, data: bytes):
+        return self._loads(data)
+
+
+class OrjsonSerializer(Serializer):
+    """uses "orjson" (rust), serializes datetimes and uuids itself, this is the fastest backend"""
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._dumps, self._loads = orjson.dumps, orjson.loads
+
+    def dumps(self, content) -> bytes:
+        return self._dumps(content, default=self._default)
+
+
+class UjsonSerializer(Serializer):
+    """uses "ujson" (c), datetimes are serialized by the same fallback as the stdlib backend"""
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._dumps, self._loads = ujson.dumps, ujson.loads
+
+    def dumps(self, content) -> bytes:
+        x = self._dumps(content, ensure_ascii=False, escape_forward_slashes=False, default=self._default)
+        return x.encode('utf-8')
+
+
+BACKENDS = {_.name: _ for _ in (OrjsonSerializer, UjsonSerializer, Serializer)}  # ordered by preference
+
+
+def create_serializer(backend: str = 'auto') -> Serializer:
+    """returns a serializer for the requested backend, or the fastest available one for "auto" """
+    if backend != 'auto':
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown json backend "{backend}", choose one of: auto, {", ".join(BACKENDS.keys())}')
+        return BACKENDS[backend]()
+
+    for serializer in BACKENDS.values():
+        try:
+            return serializer()
+        except ImportError:
+            continue
+
+
+def create_response_class(serializer: Serializer) -> type:
+    """returns a "JSONResponse" class, which renders its content with the given serializer"""
+
+    class Response(JSONResponse):
+        def render(self, content) -> bytes:
+            return serializer.dumps(content)
+
+    return Response
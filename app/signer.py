@@ -0,0 +1,107 @@
+from jose import jws, jwk, jwt
+from jose.backends.base import Key
+from jose.constants import ALGORITHMS
+
+
+class Signer:
+    """
+    Signs and verifies RS256 JWTs with the instance key.
+
+    This base implementation uses python-jose keys, which use "cryptography" if installed and otherwise fall back to
+    a pure-python rsa implementation (e.g. on alpine). Other backends only replace the raw signature operations with
+    their own jose-"Key", header, payload and claims are still handled by python-jose, so the output is byte-identical.
+    """
+
+    name = 'jose'
+
+    def __init__(self, private_key: "RsaKey", public_key: "RsaKey"):
+        self._encode_key = jwk.construct(private_key.export_key().decode('utf-8'), algorithm=ALGORITHMS.RS256)
+        self._decode_key = jwk.construct(public_key.export_key().decode('utf-8'), algorithm=ALGORITHMS.RS256)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name})'
+
+    def sign(self, payload: dict, headers: dict = None) -> str:
+        return jws.sign(payload, key=self._encode_key, headers=headers, algorithm=ALGORITHMS.RS256)
+
+    def decode(self, token: str, options: dict = None) -> dict:
+        return jwt.decode(token=token, key=self._decode_key, algorithms=ALGORITHMS.RS256, options=options)
+
+
+class CryptographySigner(Signer):
+    """uses "cryptography" (openssl) directly, this is the fastest backend"""
+
+    name = 'cryptography'
+
+    class RSAKey(Key):
+        def __init__(self, key: "RsaKey", private: bool):
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.asymmetric import padding
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+
+            super().__init__(key, ALGORITHMS.RS256)
+            pem = key.export_key()
+            self.__key = load_pem_private_key(pem, password=None) if private else load_pem_public_key(pem)
+            self.__padding, self.__hash = padding.PKCS1v15(), hashes.SHA256()
+
+        def sign(self, msg: bytes) -> bytes:
+            return self.__key.sign(msg, self.__padding, self.__hash)
+
+        def verify(self, msg: bytes, sig: bytes) -> bool:
+            from cryptography.exceptions import InvalidSignature
+
+            try:
+                self.__key.verify(sig, msg, self.__padding, self.__hash)
+                return True
+            except InvalidSignature:
+                return False
+
+    def __init__(self, private_key: "RsaKey", public_key: "RsaKey"):
+        self._encode_key = self.RSAKey(private_key, private=True)
+        self._decode_key = self.RSAKey(public_key, private=False)
+
+
+class PycryptodomeSigner(Signer):
+    """
+    uses "pycryptodome", which is always installed, for signing (native modular exponentiation, ~10x faster than
+    pure-python). Verifying uses the small public exponent, where python-jose's key is faster, so it is kept.
+    """
+
+    name = 'pycryptodome'
+
+    class RSAKey(Key):
+        def __init__(self, key: "RsaKey"):
+            try:
+                # Crypto | Cryptodome on Debian
+                from Crypto.Hash import SHA256
+                from Crypto.Signature import pkcs1_15
+            except ModuleNotFoundError:
+                from Cryptodome.Hash import SHA256
+                from Cryptodome.Signature import pkcs1_15
+
+            super().__init__(key, ALGORITHMS.RS256)
+            self.__sha256, self.__scheme = SHA256, pkcs1_15.new(key)
+
+        def sign(self, msg: bytes) -> bytes:
+            return self.__scheme.sign(self.__sha256.new(msg))
+
+    def __init__(self, private_key: "RsaKey", public_key: "RsaKey"):
+        super().__init__(private_key, public_key)
+        self._encode_key = self.RSAKey(private_key)
+
+
+BACKENDS = {_.name: _ for _ in (CryptographySigner, PycryptodomeSigner, Signer)}  # ordered by preference
+
+
+def create_signer(private_key: "RsaKey", public_key: "RsaKey", backend: str = 'auto') -> Signer:
+    """returns a signer for the requested backend, or the fastest available one for "auto" """
+    if backend != 'auto':
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown jwt backend "{backend}", choose one of: auto, {", ".join(BACKENDS.keys())}')
+        return BACKENDS[backend](private_key, public_key)
+
+    for signer in BACKENDS.values():
+        try:
+            return signer(private_key, public_key)
+        except ImportError:
+            continue
@@ -1,10 +1,17 @@
+from collections import OrderedDict
+from functools import lru_cache
+from time import time
+
+
 def load_file(filename) -> bytes:
     with open(filename, 'rb') as file:
         content = file.read()
     return content
 
 
+@lru_cache(maxsize=None)
 def load_key(filename) -> "RsaKey":
+    # parsing keys is expensive, keys are immutable and only loaded once per file
     try:
         # Crypto | Cryptodome on Debian
         from Crypto.PublicKey import RSA
@@ -13,7 +20,43 @@ def load_key(filename) -> "RsaKey":
         from Cryptodome.PublicKey import RSA
         from Cryptodome.PublicKey.RSA import RsaKey
 
-    return RSA.import_key(extern_key=load_file(filename), passphrase=None)
+    content = load_file(filename)
+    return _import_private_key(content) or RSA.import_key(extern_key=content, passphrase=None)
+
+
+def _import_private_key(content: bytes) -> "RsaKey":
+    """
+    Imports unencrypted PKCS#1 and PKCS#8 private keys without the primality tests of "RSA.import_key", which take most
+    of the startup time. The cheap consistency checks are kept. Returns "None" for all other formats.
+    """
+    try:
+        # Crypto | Cryptodome on Debian
+        from Crypto.IO import PEM, PKCS8
+        from Crypto.PublicKey import RSA
+        from Crypto.Util.asn1 import DerSequence
+    except ModuleNotFoundError:
+        from Cryptodome.IO import PEM, PKCS8
+        from Cryptodome.PublicKey import RSA
+        from Cryptodome.Util.asn1 import DerSequence
+
+    try:
+        der, marker, encrypted = PEM.decode(content.decode('utf-8'))
+    except ValueError:
+        return None
+    if encrypted or marker not in ('RSA PRIVATE KEY', 'PRIVATE KEY'):
+        return None
+    if marker == 'PRIVATE KEY':
+        oid, der, _ = PKCS8.unwrap(der)
+        if oid != '1.2.840.113549.1.1.1':  # rsaEncryption
+            return None
+
+    x = DerSequence().decode(der, nr_elements=9, only_ints_expected=True)
+    if x[0] != 0:  # version
+        return None
+    n, e, d, p, q = x[1:6]
+    if p * q != n or (e * d) % (p - 1) != 1 or (e * d) % (q - 1) != 1:
+        raise ValueError('invalid rsa private key')
+    return RSA.construct((n, e, d, p, q), consistency_check=False)
 
 
 def generate_key() -> "RsaKey":
@@ -26,3 +69,38 @@ def generate_key() -> "RsaKey":
         from Cryptodome.PublicKey.RSA import RsaKey
 
     return RSA.generate(bits=2048)
+
+
+class ExpiringLRUCache:
+    """
+    Bounded least-recently-used cache, where every entry has its own expiry (unix timestamp).
+    Not thread-safe, it is meant to be used from the event-loop only.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.__entries = OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time():
+            del self.__entries[key]
+            return default
+        self.__entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value, expires: float):
+        if self.maxsize <= 0 or expires <= time():
+            return
+        self.__entries[key] = (expires, value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        self.__entries.clear()
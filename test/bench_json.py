@@ -0,0 +1,109 @@
+"""
+Micro-benchmark for the json serializer backends, on the payloads of "/leasing/v1/lessor" (response and request body)
+and "/-/leases" (a page of leases with their origins). "json (isoformat)" is the previous path, which converted every
+datetime with "isoformat()" before passing the payload to the stdlib.
+
+    cd test && python bench_json.py [iterations] [leases]
+"""
+from datetime import datetime, timedelta
+from json import dumps as json_dumps, loads as json_loads
+from time import perf_counter
+from uuid import uuid4
+import sys
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from app.serializer import BACKENDS
+
+
+def lessor_payloads() -> (dict, bytes):
+    """response of "/leasing/v1/lessor" with one lease, and its request body"""
+    now = datetime.utcnow()
+    response = {
+        "client_challenge": "00000000-0000-0000-0000-000000000000",
+        "lease_result_list": [{
+            "ordinal": 0,
+            "lease": {
+                "ref": str(uuid4()),
+                "created": now,
+                "expires": now + timedelta(days=90),
+                "recommended_lease_renewal": 0.15,
+                "offline_lease": "true",
+                "license_type": "CONCURRENT_COUNTED_SINGLE"
+            }
+        }],
+        "result_code": "SUCCESS",
+        "sync_timestamp": now,
+        "prompts": None
+    }
+    request = {
+        "fulfillment_context": {"fulfillment_class_ref_list": []},
+        "lease_proposal_list": [{"license_type_qualifiers": {"count": 1}, "product": {"name": "NVIDIA RTX Virtual Workstation"}}],
+        "proposal_evaluation_mode": "ALL_OF",
+        "scope_ref_list": ["20000000-0000-0000-0000-000000000001"],
+    }
+    return response, json_dumps(request).encode('utf-8')
+
+
+def leases_payload(count: int) -> list:
+    """rows of "/-/leases?origin=true" (serialized leases with their origin)"""
+    now, rows = datetime.utcnow(), []
+    for _ in range(count):
+        rows.append({
+            'lease_ref': str(uuid4()), 'origin_ref': str(uuid4()), 'scope_ref': str(uuid4()),
+            'lease_created': now, 'lease_expires': now + timedelta(days=90), 'lease_updated': now,
+            'lease_renewal': now + timedelta(days=13, hours=12),
+            'origin': {'origin_ref': str(uuid4()), 'hostname': 'ubuntu-grid-server', 'guest_driver_version': '550.90.07',
+                       'os_platform': 'Ubuntu 24.04', 'os_version': '24.04 LTS (Noble Numbat)'},
+        })
+    return rows
+
+
+def isoformat(content):
+    """previous path: datetimes were converted to strings before serializing"""
+    if isinstance(content, dict):
+        return {k: isoformat(v) for k, v in content.items()}
+    if isinstance(content, list):
+        return [isoformat(_) for _ in content]
+    return content.isoformat() if isinstance(content, datetime) else content
+
+
+def microseconds(func, iterations: int) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        func()
+    return (perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations: int, leases: int):
+    lessor, body = lessor_payloads()
+    rows = leases_payload(leases)
+
+    print(f'{"backend":<18} {"lessor dumps us":>16} {"lessor loads us":>16} {f"{leases} leases dumps ms":>20}  identical')
+    reference = json_dumps(isoformat(rows), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    x = (
+        microseconds(lambda: json_dumps(isoformat(lessor), ensure_ascii=False, separators=(',', ':')).encode('utf-8'), iterations),
+        microseconds(lambda: json_loads(body.decode('utf-8')), iterations),
+        microseconds(lambda: json_dumps(isoformat(rows), ensure_ascii=False, separators=(',', ':')).encode('utf-8'), max(1, iterations // leases)) / 1000,
+    )
+    print(f'{"json (isoformat)":<18} {x[0]:>16.2f} {x[1]:>16.2f} {x[2]:>20.2f}  True')
+
+    for name, backend in BACKENDS.items():
+        try:
+            serializer = backend()
+        except ImportError:
+            print(f'{name:<18} {"not installed":>16}')
+            continue
+
+        x = (
+            microseconds(lambda: serializer.dumps(lessor), iterations),
+            microseconds(lambda: serializer.loads(body), iterations),
+            microseconds(lambda: serializer.dumps(rows), max(1, iterations // leases)) / 1000,
+        )
+        print(f'{name:<18} {x[0]:>16.2f} {x[1]:>16.2f} {x[2]:>20.2f}  {serializer.dumps(rows) == reference}')
+
+
+if __name__ == '__main__':
+    main(iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 20000, leases=int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,67 @@
+"""
+Simulates a fleet of clients which boot at the same moment and renew their leases as recommended by the server,
+to show how renewal jitter (and the adaptive mode) flattens the resulting renewal storms. No database or network is
+used, only the renewal scheduler of the app with a simulated clock.
+
+    cd test && python bench_renewal_jitter.py --clients 10000 --boot-window 60 --cycles 10
+    cd test && python bench_renewal_jitter.py --jitter 0 0.1 0.25 --target-rate 5
+"""
+from argparse import ArgumentParser
+from collections import Counter
+from heapq import heappush, heappop
+from random import Random
+import sys
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from app.renewals import RenewalScheduler
+
+
+def simulate(clients: int, boot_window: float, cycles: int, lease_seconds: float, period: float, jitter: float,
+             target_rate: float, seed: int = 0) -> Counter:
+    """returns the number of requests (new leases and renewals) per second"""
+    rand, now = Random(seed), 0.0
+    scheduler = RenewalScheduler(period, jitter=jitter, target_rate=target_rate, rand=rand.random, clock=lambda: now)
+
+    events = []  # (time, client, remaining renewals)
+    for client in range(clients):
+        heappush(events, (rand.uniform(0, boot_window), client, cycles))
+
+    per_second = Counter()
+    while len(events) > 0:
+        now, client, remaining = heappop(events)
+        scheduler.observe()
+        per_second[int(now)] += 1
+        if remaining > 0:
+            heappush(events, (now + scheduler.recommended_renewal() * lease_seconds, client, remaining - 1))
+    return per_second
+
+
+def summarize(per_second: Counter, skip: float) -> dict:
+    """peak and 99th percentile of requests per second, ignoring the initial boot (first "skip" seconds)"""
+    values = sorted(v for k, v in per_second.items() if k >= skip)
+    if len(values) == 0:
+        return {'peak': 0, 'p99': 0}
+    return {'peak': values[-1], 'p99': values[min(len(values) - 1, round(0.99 * len(values)))]}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='simulates renewal storms of a fleet which boots at the same moment')
+    parser.add_argument('--clients', type=int, default=5000, help='number of clients')
+    parser.add_argument('--boot-window', type=float, default=10, help='seconds in which all clients boot')
+    parser.add_argument('--cycles', type=int, default=8, help='renewals per client')
+    parser.add_argument('--lease-seconds', type=float, default=3600, help='lease duration (default: 1 hour)')
+    parser.add_argument('--period', type=float, default=0.15, help='"LEASE_RENEWAL_PERIOD"')
+    parser.add_argument('--jitter', type=float, nargs='+', default=[0, 0.1, 0.25, 0.5], help='"LEASE_RENEWAL_JITTER" values')
+    parser.add_argument('--target-rate', type=float, default=0, help='"LEASE_RENEWAL_TARGET_RATE" (0: not adaptive)')
+    args = parser.parse_args()
+
+    print(f'{args.clients} clients booting within {args.boot_window}s, {args.cycles} renewals each')
+    print(f'{"jitter":>8} {"adaptive":>9} {"peak req/s":>11} {"p99 req/s":>10}')
+    for jitter in args.jitter:
+        for target_rate in sorted({0, args.target_rate}):
+            per_second = simulate(args.clients, args.boot_window, args.cycles, args.lease_seconds, args.period, jitter, target_rate)
+            x = summarize(per_second, skip=args.boot_window)
+            print(f'{jitter:>8.2f} {target_rate if target_rate > 0 else "-":>9} {x["peak"]:>11} {x["p99"]:>10}')
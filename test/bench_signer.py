@@ -0,0 +1,53 @@
+"""
+Micro-benchmark for the jwt signer backends (sign / verify operations per second with the instance key).
+
+    cd test && python bench_signer.py [iterations]
+"""
+from os.path import dirname, join
+from time import perf_counter
+import sys
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from app.util import load_key
+from app.signer import BACKENDS
+
+INSTANCE_KEY_RSA = load_key(str(join(dirname(__file__), '../app/cert/instance.private.pem')))
+INSTANCE_KEY_PUB = load_key(str(join(dirname(__file__), '../app/cert/instance.public.pem')))
+
+PAYLOAD = {
+    'iat': 1700000000, 'nbf': 1700000000, 'exp': 4102444800,
+    'iss': 'https://cls.nvidia.org', 'aud': 'https://cls.nvidia.org',
+    'origin_ref': '00000000-0000-0000-0000-000000000000',
+    'key_ref': '00000000-0000-0000-0000-000000000000', 'kid': '00000000-0000-0000-0000-000000000000',
+}
+
+
+def ops_per_second(func, iterations: int) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (perf_counter() - start)
+
+
+def main(iterations: int):
+    reference = None
+    print(f'{"backend":<14} {"sign/s":>10} {"verify/s":>10}  identical')
+    for name, backend in BACKENDS.items():
+        try:
+            signer = backend(INSTANCE_KEY_RSA, INSTANCE_KEY_PUB)
+        except ImportError:
+            print(f'{name:<14} {"not installed":>21}')
+            continue
+
+        token = signer.sign(PAYLOAD, headers={'kid': PAYLOAD.get('kid')})
+        reference = reference or token
+        sign = ops_per_second(lambda: signer.sign(PAYLOAD, headers={'kid': PAYLOAD.get('kid')}), iterations)
+        verify = ops_per_second(lambda: signer.decode(token, options={'verify_aud': False}), iterations)
+        print(f'{name:<14} {sign:>10.1f} {verify:>10.1f}  {token == reference}')
+
+
+if __name__ == '__main__':
+    main(iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 200)
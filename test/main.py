@@ -59,6 +59,34 @@ def test_readme():
     assert response.status_code == 200
 
 
+def test_readme_cache():
+    from gzip import decompress
+
+    response = client.get('/-/readme', headers={'accept-encoding': 'identity'})
+    assert response.status_code == 200
+    assert response.headers.get('content-encoding') is None
+    html, etag, last_modified = response.content, response.headers['etag'], response.headers['last-modified']
+    assert etag.startswith('W/"')
+
+    response = client.get('/-/readme', headers={'accept-encoding': 'gzip, deflate'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.content == html  # decoded by client
+    assert decompress(main.readme_cache['encoded']['gzip']) == html
+
+    response = client.get('/-/readme', headers={'accept-encoding': 'gzip;q=0'})
+    assert response.headers.get('content-encoding') is None
+
+    response = client.get('/-/readme', headers={'if-none-match': etag})
+    assert response.status_code == 304 and response.content == b''
+    assert response.headers['etag'] == etag
+
+    response = client.get('/-/readme', headers={'if-modified-since': last_modified})
+    assert response.status_code == 304
+
+    response = client.get('/-/readme', headers={'if-none-match': 'W/"other"', 'if-modified-since': last_modified})
+    assert response.status_code == 200
+
+
 def test_manage():
     response = client.get('/-/manage')
     assert response.status_code == 200
@@ -70,7 +98,13 @@ def test_client_token():
 
 
 def test_origins():
-    pass
+    response = client.get('/-/origins')
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+    response = client.get('/-/origins?leases=true')
+    assert response.status_code == 200
+    assert all(isinstance(_.get('leases'), list) for _ in response.json())
 
 
 def test_origins_delete():
@@ -78,7 +112,13 @@ def test_origins_delete():
 
 
 def test_leases():
-    pass
+    response = client.get('/-/leases')
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+    response = client.get('/-/leases?origin=true')
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
 
 
 def test_lease_delete():
@@ -240,3 +280,975 @@ def test_leasing_v1_lessor_lease_remove():
     assert len(released_lease_list) == 1
     assert len(released_lease_list[0]) == 36
     assert released_lease_list[0] == lease_ref
+
+
+def test_database_does_not_block_event_loop():
+    import asyncio
+    from threading import Event
+    from httpx import AsyncClient
+
+    payload = {
+        "registration_pending": False,
+        "environment": {
+            "guest_driver_version": "guest_driver_version",
+            "hostname": "myhost",
+            "ip_address_list": ["192.168.1.123"],
+            "os_version": "os_version",
+            "os_platform": "os_platform",
+            "fingerprint": {"mac_address_list": ["ff:ff:ff:ff:ff:ff"]},
+            "host_driver_version": "host_driver_version"
+        },
+        "update_pending": False,
+        "candidate_origin_ref": ORIGIN_REF,
+    }
+
+    create_or_update, entered, stalled = main.Origin.create_or_update, Event(), Event()
+
+    def stalled_create_or_update(engine, origin):
+        entered.set()
+        stalled.wait(timeout=5)
+        create_or_update(engine, origin)
+
+    async def scenario():
+        async with AsyncClient(app=main.app, base_url='http://testserver') as ac:
+            write = asyncio.create_task(ac.post('/auth/v1/origin', json=payload))
+            while not entered.is_set():
+                await asyncio.sleep(0.01)
+
+            # while the write is stalled in the database, other requests must still be served
+            response = await asyncio.wait_for(ac.get('/-/health'), timeout=1)
+            assert response.status_code == 200
+            assert not write.done()
+
+            stalled.set()
+            return await write
+
+    main.Origin.create_or_update = staticmethod(stalled_create_or_update)
+    try:
+        response = asyncio.run(scenario())
+    finally:
+        main.Origin.create_or_update = staticmethod(create_or_update)
+        stalled.set()
+
+    assert response.status_code == 200
+    assert response.json().get('origin_ref') == ORIGIN_REF
+
+
+def test_database_engine_and_session_factory():
+    from tempfile import TemporaryDirectory
+    from sqlalchemy import text
+    from app.orm import create_engine, session_factory
+
+    assert session_factory(main.db) is session_factory(main.db)
+
+    with TemporaryDirectory() as tmp:
+        engine = create_engine(f'sqlite:///{tmp}/db.sqlite', pool_size=2, max_overflow=0, sqlite_wal=True)
+        assert engine.pool.size() == 2
+        with session_factory(engine)() as session:
+            assert session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        engine.dispose()
+
+    engine = create_engine('sqlite://', pool_size=2)  # in-memory, pool options are ignored
+    with session_factory(engine)() as session:
+        assert session.execute(text('SELECT 1')).scalar() == 1
+
+
+def test_database_upsert_single_statement():
+    from sqlalchemy import event
+    from app.orm import create_engine, init, Origin, Lease
+
+    engine = create_engine('sqlite://')
+    init(engine)
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+
+    origin_ref, lease_ref, cur_time = str(uuid4()), str(uuid4()), datetime.utcnow()
+    Origin.create_or_update(engine, Origin(origin_ref=origin_ref, hostname='first'))
+    Origin.create_or_update(engine, Origin(origin_ref=origin_ref, hostname='second'))
+    assert len(statements) == 2
+    assert all(_.startswith('INSERT') and 'ON CONFLICT' in _ for _ in statements)
+
+    lease = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=cur_time)
+    Lease.create_or_update(engine, lease)
+    lease = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=cur_time + relativedelta(days=1), lease_updated=cur_time)
+    Lease.create_or_update(engine, lease)
+    assert len(statements) == 4
+
+    entity = Lease.find_by_lease_ref(engine, lease_ref)
+    assert entity.lease_expires == cur_time + relativedelta(days=1)
+    assert len(Lease.find_by_origin_ref(engine, origin_ref)) == 1
+
+
+def test_leasing_v1_lessor_multiple_scopes():
+    from sqlalchemy import event
+
+    payload = {
+        'fulfillment_context': {
+            'fulfillment_class_ref_list': []
+        },
+        'lease_proposal_list': [{
+            'license_type_qualifiers': {'count': 1},
+            'product': {'name': 'NVIDIA RTX Virtual Workstation'}
+        }],
+        'proposal_evaluation_mode': 'ALL_OF',
+        'scope_ref_list': [ALLOTMENT_REF, str(uuid4()), str(uuid4())]
+    }
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(main.db, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.post('/leasing/v1/lessor', json=payload, headers={'authorization': __bearer_token(ORIGIN_REF)})
+    finally:
+        event.remove(main.db, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+
+    lease_result_list = response.json().get('lease_result_list')
+    assert len(lease_result_list) == 3
+    assert len(list(filter(lambda _: _.startswith('INSERT'), statements))) == 1
+
+    response = client.delete('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+    assert response.status_code == 200
+    assert len(response.json().get('released_lease_list')) == 3
+
+
+def test_expiring_lru_cache():
+    from time import time
+    from app.util import ExpiringLRUCache
+
+    cache = ExpiringLRUCache(maxsize=2)
+    cache.put('a', 1, expires=time() + 60)
+    cache.put('b', 2, expires=time() + 60)
+    assert cache.get('a') == 1  # "a" is now most recently used
+    cache.put('c', 3, expires=time() + 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    cache.put('d', 4, expires=time() - 1)  # already expired tokens are never cached
+    assert cache.get('d') is None
+    assert len(cache) == 2
+
+
+def test_token_cache():
+    cur_time = datetime.utcnow()
+    payload = {'origin_ref': ORIGIN_REF, 'exp': timegm((cur_time + relativedelta(hours=1)).timetuple())}
+    token = f'Bearer {jwt.encode(payload, key=jwt_encode_key, algorithm=ALGORITHMS.RS256)}'
+
+    decode, calls = main.jwt_signer.decode, []
+
+    def counting_decode(*args, **kwargs):
+        calls.append(1)
+        return decode(*args, **kwargs)
+
+    main.jwt_signer.decode = counting_decode
+    try:
+        for _ in range(3):
+            response = client.get('/leasing/v1/lessor/leases', headers={'authorization': token})
+            assert response.status_code == 200
+    finally:
+        del main.jwt_signer.decode
+
+    assert len(calls) == 1
+
+
+def test_client_token_cache():
+    response = client.get('/-/client-token')
+    payload = jwt.get_unverified_claims(token=response.content.decode('utf-8'))
+    assert payload.get('service_instance_public_key_configuration').get('service_instance_public_key_me').get('mod') == hex(INSTANCE_KEY_PUB.public_key().n)[2:]
+    assert client.get('/-/client-token').content != response.content
+
+    main.CLIENT_TOKEN_CACHE_SECONDS = 60
+    try:
+        response = client.get('/-/client-token')
+        assert client.get('/-/client-token').content == response.content
+    finally:
+        main.CLIENT_TOKEN_CACHE_SECONDS = 0
+        main.client_token_cache.update(content=None, created=None)
+
+    assert client.get('/-/client-token').content != response.content
+
+
+def test_signer_backends():
+    from jose import JWTError
+    from app.signer import BACKENDS
+
+    payload, headers = {'origin_ref': ORIGIN_REF, 'exp': timegm((datetime.utcnow() + relativedelta(hours=1)).timetuple())}, {'kid': 'kid'}
+    reference = jwt.encode(payload, key=jwt_encode_key, headers=headers, algorithm=ALGORITHMS.RS256)
+
+    signers = []
+    for backend in BACKENDS.values():
+        try:
+            signers.append(backend(INSTANCE_KEY_RSA, INSTANCE_KEY_PUB))
+        except ImportError:
+            continue
+    assert len(signers) >= 2  # "pycryptodome" and "jose" are always available
+
+    for signer in signers:
+        assert signer.sign(payload, headers=headers) == reference  # byte-identical, clients validate the same way
+        assert signer.decode(reference) == payload
+
+        try:
+            signer.decode(f'{reference[:-4]}AAAA')
+            assert False, f'{signer} accepted an invalid signature'
+        except JWTError:
+            pass
+
+        expired = signer.sign({'exp': timegm((datetime.utcnow() - relativedelta(hours=1)).timetuple())})
+        try:
+            signer.decode(expired)
+            assert False, f'{signer} accepted an expired token'
+        except JWTError:
+            pass
+
+
+def test_serializer_backends():
+    from json import dumps
+    from app.serializer import BACKENDS
+
+    now = datetime.utcnow()
+    content = {'lease_ref': str(uuid4()), 'hostname': 'höst/1', 'created': now, 'expires': now.replace(microsecond=0), 'x': [1, 0.15, None, True]}
+    reference = dumps({**content, 'created': now.isoformat(), 'expires': now.replace(microsecond=0).isoformat()},
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    serializers = []
+    for backend in BACKENDS.values():
+        try:
+            serializers.append(backend())
+        except ImportError:
+            continue
+    assert len(serializers) >= 1  # "json" is always available
+
+    for serializer in serializers:
+        assert serializer.dumps(content) == reference, f'{serializer} output differs'  # same output for every backend
+        assert serializer.loads(reference) == main.json_serializer.loads(reference.decode('utf-8'))
+
+
+def test_logging(caplog):
+    import logging
+    from io import StringIO
+    from threading import current_thread
+    from app.logs import setup
+
+    with caplog.at_level(logging.INFO, logger='main'):
+        test_auth_v1_origin()
+    record = [_ for _ in caplog.records if getattr(_, 'event', None) == 'origin'][-1]  # written after the response
+    assert record.getMessage().startswith(f'> [  origin  ]: {ORIGIN_REF}: ')
+    assert (record.origin_ref, record.route, record.status) == (ORIGIN_REF, '/auth/v1/origin', 200)
+    assert record.latency_ms >= 0
+
+    class Arg:
+        formatted_by = None
+
+        def __str__(self):
+            Arg.formatted_by = current_thread()
+            return 'arg'
+
+    stream, logger = StringIO(), logging.getLogger('test_logging')
+    logger.propagate = False
+    listener = setup(format='json', sample={'renew': 3}, serializer=main.json_serializer, logger=logger, stream=stream)
+    for i in range(6):
+        logger.warning('renew %s', i, extra={'event': 'renew', 'origin_ref': ORIGIN_REF})
+    logger.warning('origin %s', Arg(), extra={'event': 'origin'})
+    listener.stop()  # drains the queue
+    logger.handlers.clear()
+
+    rows = [main.json_serializer.loads(_) for _ in stream.getvalue().splitlines()]
+    assert [_['message'] for _ in rows] == ['renew 0', 'renew 3', 'origin arg']  # every 3rd renewal
+    assert rows[0]['sampled'] == 3 and rows[0]['origin_ref'] == ORIGIN_REF and 'sampled' not in rows[2]
+    assert Arg.formatted_by not in (None, current_thread())  # formatted by the listener thread
+
+
+def test_metrics():
+    client.get('/-/health')
+    response = client.get('/-/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+
+    content = response.text
+    assert 'dls_http_requests_total{method="GET",route="/-/health",status="200"}' in content
+    assert 'dls_http_request_duration_seconds_bucket{method="GET",route="/-/health",le="+Inf"}' in content
+    assert 'dls_db_query_duration_seconds_count{operation="Lease.count_active"}' in content
+    assert 'dls_jwt_duration_seconds_count{operation="sign"}' in content
+    assert 'dls_leases_active ' in content
+
+
+def test_metrics_multiprocess():
+    from glob import glob
+    from os import utime
+    from tempfile import TemporaryDirectory
+    from app.metrics import Registry, Counter, Histogram, Gauge
+
+    with TemporaryDirectory() as tmp:
+        registries = []
+        for i in range(2):  # two "workers" sharing one directory
+            registry = Registry(directory=tmp, identity=str(i))
+            registry.register(Counter('requests_total', 'Requests.', labels=('route',))).inc(route='/')
+            registry.register(Histogram('latency_seconds', 'Latency.', buckets=(.1, 1))).observe(.5)
+            registry.register(Gauge('active', 'Active.', shared=False)).set(10 + i)
+            registry.dump()
+            registries.append(registry)
+
+        content = registries[1].expose()
+        assert 'requests_total{route="/"} 2.0' in content
+        assert 'latency_seconds_bucket{le="1"} 2.0' in content
+        assert 'latency_seconds_count 2.0' in content
+        assert 'active 11' in content  # gauges are not summed up
+
+        registries[1].remove()  # shut down
+        assert 'requests_total{route="/"} 1.0' in registries[0].expose()
+
+        utime(join(tmp, 'metrics_0.json'), (0, 0))  # died without shutting down, so its dump gets stale
+        registry = Registry(directory=tmp, identity='2')
+        registry.register(Counter('requests_total', 'Requests.', labels=('route',)))
+        assert 'requests_total{route="/"}' not in registry.expose()
+        assert glob(join(tmp, 'metrics_*.json')) == [join(tmp, 'metrics_2.json')]
+
+
+def test_leases_pagination():
+    from json import loads
+
+    origin_ref, cur_time = str(uuid4()), datetime.utcnow()
+    main.Origin.create_or_update(main.db, main.Origin(origin_ref=origin_ref, hostname='pagination'))
+    leases = [main.Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time) for _ in range(5)]
+    main.Lease.create_many(main.db, leases)
+
+    lease_refs, after = [], None
+    while True:
+        response = client.get('/-/leases', params=dict(origin=True, limit=2, **({'after': after} if after else {})))
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        lease_refs.extend(_['lease_ref'] for _ in response.json() if _['origin_ref'] == origin_ref)
+        assert all(_['origin']['origin_ref'] == _['origin_ref'] for _ in response.json() if _['origin_ref'] == origin_ref)
+        after = response.headers.get('X-Next-Cursor')
+        if after is None:
+            break
+    assert sorted(lease_refs) == sorted(_.lease_ref for _ in leases)
+
+    main.ADMIN_PAGE_SIZE = 2  # stream over multiple pages
+    try:
+        streamed = client.get('/-/leases').json()
+        response = client.get('/-/leases', headers={'accept': 'application/x-ndjson'})
+        origins = client.get('/-/origins?leases=true&format=ndjson')
+    finally:
+        main.ADMIN_PAGE_SIZE = 1000
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert [loads(_) for _ in response.text.splitlines()] == streamed
+    assert len(set(_['lease_ref'] for _ in streamed)) == len(streamed)
+    assert set(_.lease_ref for _ in leases).issubset(_['lease_ref'] for _ in streamed)
+
+    origin = next(loads(_) for _ in origins.text.splitlines() if loads(_)['origin_ref'] == origin_ref)
+    assert len(origin['leases']) == 5
+
+    for path in ('/-/leases', '/-/origins'):
+        for limit in (0, -1, main.ADMIN_PAGE_SIZE + 1):
+            assert client.get(path, params=dict(limit=limit)).status_code == 422
+
+    main.Lease.cleanup(main.db, origin_ref)
+
+
+def test_lease_index():
+    from sqlalchemy import event
+    from app.index import LeaseIndex
+
+    main.lease_index = LeaseIndex()
+    try:
+        assert main.lease_index.ready is False
+        with TestClient(main.app):  # runs startup, which warms the index
+            pass
+        assert main.lease_index.ready is True
+
+        lease_ref = test_leasing_v1_lessor()
+        assert main.lease_index.exists(ORIGIN_REF, lease_ref)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(main.db, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+            assert response.json().get('active_lease_list') == [lease_ref]
+            assert len(statements) == 0  # answered from memory
+
+            response = client.put(f'/leasing/v1/lease/{str(uuid4())}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+            assert response.status_code == 404
+            assert len(statements) == 0
+
+            response = client.put(f'/leasing/v1/lease/{lease_ref}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+            assert response.status_code == 200
+            assert len(statements) == 1 and statements[0].startswith('UPDATE')
+        finally:
+            event.remove(main.db, 'before_cursor_execute', before_cursor_execute)
+
+        expired_ref = str(uuid4())  # expired leases are neither active nor renewable, until the reaper deletes them
+        main.lease_index.put(expired_ref, ORIGIN_REF, datetime.utcnow())
+        response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert response.json().get('active_lease_list') == [lease_ref]
+        assert client.put(f'/leasing/v1/lease/{expired_ref}', headers={'authorization': __bearer_token(ORIGIN_REF)}).status_code == 404
+        main.lease_index.remove(expired_ref)
+
+        # deletes only remove the deleted leases, leases written meanwhile (e.g. "concurrent_ref") stay in the index
+        cur_time, concurrent_ref = datetime.utcnow(), str(uuid4())
+        main.Lease.create_many(main.db, [main.Lease(origin_ref=ORIGIN_REF, lease_ref=expired_ref, lease_created=cur_time, lease_expires=cur_time)])
+        main.lease_index.put(expired_ref, ORIGIN_REF, cur_time)
+        main.lease_index.put(concurrent_ref, ORIGIN_REF, cur_time + relativedelta(days=1))
+        assert client.delete('/-/leases/expired').status_code == 201
+        assert main.lease_index.get_origin_ref(expired_ref) is None
+        assert main.lease_index.exists(ORIGIN_REF, concurrent_ref) and main.lease_index.exists(ORIGIN_REF, lease_ref)
+        main.lease_index.remove(concurrent_ref)
+
+        response = client.delete(f'/leasing/v1/lease/{lease_ref}', headers={'authorization': __bearer_token(str(uuid4()))})
+        assert response.status_code == 403
+
+        response = client.delete('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert response.json().get('released_lease_list') == [lease_ref]
+        assert not main.lease_index.exists(ORIGIN_REF, lease_ref)
+        assert len(main.lease_index.find_by_origin_ref(ORIGIN_REF)) == 0
+    finally:
+        main.lease_index = None
+
+    # same without the index
+    origin_ref, cur_time = str(uuid4()), datetime.utcnow()
+    main.Origin.create_or_update(main.db, main.Origin(origin_ref=origin_ref, hostname='expired'))
+    main.Lease.create_many(main.db, [main.Lease(origin_ref=origin_ref, lease_ref=expired_ref, lease_created=cur_time, lease_expires=cur_time)])
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(origin_ref)})
+    assert response.json().get('active_lease_list') == []
+    assert client.put(f'/leasing/v1/lease/{expired_ref}', headers={'authorization': __bearer_token(origin_ref)}).status_code == 404
+    main.Origin.delete(main.db, [origin_ref])
+
+
+def test_renewal_write_behind():
+    from asyncio import run, create_task, sleep, CancelledError
+    from app.renewals import RenewalQueue
+
+    flushed = []
+
+    async def flush(renewals):
+        flushed.append(renewals)
+
+    main.renewal_queue = RenewalQueue(flush=flush, window=60, batch_size=100)
+    try:
+        lease_ref = test_leasing_v1_lessor()
+
+        for _ in range(3):
+            response = client.put(f'/leasing/v1/lease/{lease_ref}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+            assert response.status_code == 200
+        assert len(main.renewal_queue) == 1  # coalesced
+
+        response = client.put(f'/leasing/v1/lease/{str(uuid4())}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert response.status_code == 404
+        assert len(main.renewal_queue) == 1
+
+        assert run(main.renewal_queue.flush()) == 1
+        assert len(flushed) == 1 and flushed[0][0][:2] == (ORIGIN_REF, lease_ref)
+        assert len(main.renewal_queue) == 0
+
+        # written to database in one transaction
+        expires = datetime.utcnow().replace(microsecond=0) + relativedelta(days=1)
+        assert main.Lease.renew_many(main.db, [(ORIGIN_REF, lease_ref, expires, expires), (ORIGIN_REF, str(uuid4()), expires, expires)]) == 1
+        assert main.Lease.find_by_lease_ref(main.db, lease_ref).lease_expires == expires
+
+        # a cancelled flush (e.g. on shutdown) keeps the renewals
+        async def cancelled(renewals):
+            raise CancelledError()
+
+        queue = RenewalQueue(flush=cancelled, window=60, batch_size=100)
+        queue.add(ORIGIN_REF, lease_ref, expires, expires)
+        try:
+            run(queue.flush())
+            assert False, 'flush was not cancelled'
+        except CancelledError:
+            pass
+        assert len(queue) == 1
+
+        # shutdown waits until a flush in flight is cancelled, so its renewals are written by the final flush
+        async def shutdown() -> list:
+            calls = []
+
+            async def flush(renewals):
+                calls.append(renewals)
+                if len(calls) == 1:
+                    await sleep(60)  # in flight until cancelled
+
+            main.renewal_queue = RenewalQueue(flush=flush, window=60, batch_size=1)
+            main.renewal_queue.add(ORIGIN_REF, lease_ref, expires, expires)
+            main.background_tasks.add(create_task(main.renewal_queue.run()))
+            await sleep(0.01)
+            assert len(calls) == 1 and len(main.renewal_queue) == 0
+            await main.app_on_shutdown()
+            return calls
+
+        calls = run(shutdown())
+        assert len(calls) == 2 and calls[1] == calls[0]
+    finally:
+        main.renewal_queue = None
+
+    response = client.delete('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+    assert response.status_code == 200
+
+
+def test_lease_reaper():
+    from asyncio import run
+    from sqlalchemy import inspect
+    from app.orm import create_engine, init, migrate, Origin, Lease, Lock
+
+    engine = create_engine('sqlite://')
+    init(engine), migrate(engine)
+    assert 'ix_lease_lease_expires' in [_['name'] for _ in inspect(engine).get_indexes('lease')]
+
+    origin_ref, cur_time = str(uuid4()), datetime.utcnow()
+    Origin.create_or_update(engine, Origin(origin_ref=origin_ref))
+    expired = [Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time - relativedelta(days=1)) for _ in range(5)]
+    active = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time + relativedelta(days=1))
+    Lease.create_many(engine, expired + [active])
+
+    assert len(Lease.delete_expired_chunk(engine, cur_time, limit=2)) == 2
+    assert len(Lease.delete_expired(engine, chunk_size=2)) == 3
+    assert [_.lease_ref for _ in Lease.find_by_origin_ref(engine, origin_ref)] == [active.lease_ref]
+
+    # leader election
+    worker_a, worker_b, ttl = str(uuid4()), str(uuid4()), relativedelta(seconds=60)
+    assert Lock.acquire(engine, 'test', worker_a, ttl) is True
+    assert Lock.acquire(engine, 'test', worker_a, ttl) is True  # extend
+    assert Lock.acquire(engine, 'test', worker_b, ttl) is False
+    assert Lock.acquire(engine, 'test', worker_b, relativedelta(seconds=-1)) is False
+    assert Lock.acquire(engine, 'test', worker_a, relativedelta(seconds=-1)) is True  # expire
+    assert Lock.acquire(engine, 'test', worker_b, ttl) is True
+    assert Lock.release(engine, 'test', worker_a) is False  # not the holder
+    assert Lock.release(engine, 'test', worker_b) is True
+    assert Lock.acquire(engine, 'test', worker_a, ttl) is True
+
+    # reaper of the app
+    origin_ref = str(uuid4())
+    main.Origin.create_or_update(main.db, main.Origin(origin_ref=origin_ref))
+    expired = [main.Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time - relativedelta(days=1)) for _ in range(3)]
+    main.Lease.create_many(main.db, expired)
+
+    main.LEASE_REAPER_INTERVAL, main.LEASE_REAPER_CHUNK = 60, 2
+    try:
+        assert run(getattr(main, '__reap_expired_leases')()) >= 3
+        assert len(main.Lease.find_by_origin_ref(main.db, origin_ref)) == 0
+        assert run(getattr(main, '__reap_expired_leases')()) == 0
+    finally:
+        main.LEASE_REAPER_INTERVAL, main.LEASE_REAPER_CHUNK = 0, 500
+        Lock.release(main.db, 'lease_reaper', main.worker_ref)  # so later runs against the same database can reap
+    main.Origin.delete(main.db, [origin_ref])
+
+
+def test_renewal_jitter():
+    from random import Random
+    from app.renewals import RenewalScheduler
+
+    scheduler = RenewalScheduler(0.15)
+    assert scheduler.recommended_renewal() == 0.15
+
+    scheduler = RenewalScheduler(0.15, jitter=0.2, rand=Random(0).random)
+    x = [scheduler.recommended_renewal() for _ in range(1000)]
+    assert 0.12 <= min(x) < 0.13 and 0.17 < max(x) <= 0.18
+
+    now = 0.0
+    scheduler = RenewalScheduler(0.15, target_rate=1, window=10, rand=Random(0).random, clock=lambda: now)
+    for _ in range(10):
+        scheduler.observe()
+    assert scheduler.rate() == 1 and scheduler.recommended_renewal() == 0.15  # at target, no jitter
+
+    for _ in range(10):
+        scheduler.observe()
+    assert scheduler.rate() == 2  # twice the target, spread up to twice the period, but never earlier
+    x = [scheduler.recommended_renewal() for _ in range(1000)]
+    assert 0.15 <= min(x) < 0.16 and 0.29 < max(x) <= 0.30
+
+    now = 15.0  # half of the previous window still counts
+    assert scheduler.rate() == 1
+    now = 30.0
+    assert scheduler.rate() == 0
+
+    scheduler = RenewalScheduler(0.8, jitter=1, rand=lambda: 1)
+    assert scheduler.recommended_renewal() == 0.9  # never after 90% of the lease
+
+    scheduler = RenewalScheduler(0.15, jitter=2, rand=lambda: 0)
+    assert scheduler.recommended_renewal() == 0.075  # never earlier than half the period
+
+    main.renewal_scheduler = RenewalScheduler(0.15, jitter=0.5)
+    try:
+        response = client.post('/leasing/v1/lessor', json={'scope_ref_list': [ALLOTMENT_REF]}, headers={'authorization': __bearer_token(ORIGIN_REF)})
+        lease = response.json().get('lease_result_list')[0]['lease']
+        assert 0.075 <= lease['recommended_lease_renewal'] <= 0.225
+        response = client.put(f'/leasing/v1/lease/{lease["ref"]}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert 0.075 <= response.json().get('recommended_lease_renewal') <= 0.225
+    finally:
+        main.renewal_scheduler = RenewalScheduler(main.LEASE_RENEWAL_PERIOD)
+    client.delete('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+
+
+def test_cluster_multiple_processes():
+    import subprocess
+    from os import environ
+    from os.path import exists
+    from tempfile import TemporaryDirectory
+    from app.orm import create_engine, Origin, Lease
+
+    # every process imports the app (init and migration at the same time) and replays the client handshake
+    script = '''
+import sys
+sys.path.append('../')
+sys.path.append('../app')
+from asyncio import run
+from httpx import AsyncClient
+from app import main
+from bench_handshake import Recorder, virtual_client
+
+async def clients(count: int):
+    recorder = Recorder()
+    async with AsyncClient(app=main.app, base_url='http://cluster') as client:
+        for _ in range(count):
+            await virtual_client(client, recorder, renewals=2)
+    return sum(recorder.errors.values())
+
+print(run(clients(5)))
+'''
+
+    with TemporaryDirectory() as tmp:
+        database = f'sqlite:///{tmp}/db.sqlite'
+        env = {**environ, 'DATABASE': database, 'DATABASE_SQLITE_WAL': 'true', 'CLUSTER': 'true', 'LEASE_INDEX': 'true'}
+        processes = [subprocess.Popen([sys.executable, '-c', script], cwd=dirname(__file__), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(4)]
+        for process in processes:
+            stdout, stderr = process.communicate(timeout=120)
+            assert process.returncode == 0, stderr.decode('utf-8')
+            assert stdout.decode('utf-8').strip().splitlines()[-1] == '0'  # no failed requests
+
+        assert exists(f'{tmp}/db.sqlite.lock')
+        engine = create_engine(database)
+        assert len([_ for _ in Origin.find_page(engine, limit=100)]) == 4 * 5
+        assert len(Lease.find_page(engine, limit=100)) == 0  # all returned
+        engine.dispose()
+
+
+def test_failover():
+    import subprocess
+    from json import loads
+    from os import environ
+    from tempfile import TemporaryDirectory
+    from app.ha import NodeHealth
+
+    health = {'primary': True, 'secondary': True}
+    nodes = NodeHealth([('primary', 443), ('secondary', 443)], local=1, check=lambda url, port: health[url])
+    assert nodes.query_order() == [0, 1]
+    health['primary'] = False
+    nodes.probe()
+    assert nodes.query_order() == [1, 0]
+    health['primary'] = True
+    nodes.probe()
+    assert nodes.query_order() == [0, 1]
+
+    # two instances (primary and secondary) sharing one database
+    script = '''
+import sys
+sys.path.append('../')
+sys.path.append('../app')
+from json import dumps
+from jose import jwt
+from starlette.testclient import TestClient
+from app import main
+
+client = TestClient(main.app)
+token = jwt.get_unverified_claims(client.get('/-/client-token').content.decode('utf-8'))
+origin = client.post('/auth/v1/origin', json={'candidate_origin_ref': sys.argv[1], 'environment': {}}).json()
+print(dumps([token.get('service_instance_configuration'), origin, [_['origin_ref'] for _ in client.get('/-/origins').json()]]))
+'''
+
+    with TemporaryDirectory() as tmp:
+        env = {**environ, 'DATABASE': f'sqlite:///{tmp}/db.sqlite', 'CLUSTER': 'true', 'DLS_URL': 'dls-1', 'DLS_URL_SECONDARY': 'dls-2', 'DLS_PORT_SECONDARY': '8443'}
+        results = []
+        for role, origin_ref in (('primary', str(uuid4())), ('secondary', str(uuid4()))):
+            stdout = subprocess.check_output([sys.executable, '-c', script, origin_ref], cwd=dirname(__file__), env={**env, 'HA_ROLE': role})
+            results.append((origin_ref, loads(stdout.decode('utf-8').strip().splitlines()[-1])))
+
+    for origin_ref, (configuration, origin, origin_refs) in results:
+        assert [_['url'] for _ in configuration['node_url_list']] == ['dls-1', 'dls-2']
+        assert [_['svc_port_map'][0]['port'] for _ in configuration['svc_port_set_list']] == [443, 8443]
+        assert origin['node_query_order'] == [0, 1]
+        assert origin['node_url_list'] == configuration['node_url_list']
+    assert set(_[0] for _ in results) == set(results[1][1][2])  # secondary sees origins registered on primary
+
+
+def test_database_upgrade_fast_path():
+    from sqlalchemy import event
+    from app.orm import create_engine, upgrade, SchemaVersion, SCHEMA_VERSION
+
+    engine = create_engine('sqlite://')
+    assert SchemaVersion.get(engine) is None
+    assert upgrade(engine) is True
+    assert SchemaVersion.get(engine) == SCHEMA_VERSION
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    assert upgrade(engine) is False
+    assert len(statements) == 1  # schema is current, nothing is inspected
+
+    assert set(main.startup_timings.keys()) == {'database', 'keys', 'signer'}
+
+
+def test_load_key():
+    from Crypto.PublicKey import RSA
+    from app.util import load_file, generate_key, _import_private_key
+
+    key = generate_key()
+    for pkcs in (1, 8):
+        assert _import_private_key(key.export_key(pkcs=pkcs)) == key
+    assert _import_private_key(key.public_key().export_key()) is None  # falls back to "RSA.import_key"
+    assert INSTANCE_KEY_RSA == RSA.import_key(load_file(join(dirname(__file__), '../app/cert/instance.private.pem')))
+
+
+def test_database_migrations():
+    from sqlalchemy import inspect, text
+    from app.orm import create_engine, session_factory, upgrade, migrate, SchemaVersion, SCHEMA_VERSION, Lease
+
+    # schema before 1.1 ("origin_ref" as primary-key of "lease") and before schema versioning
+    engine = create_engine('sqlite://')
+    origin_ref, lease_ref, cur_time = str(uuid4()), str(uuid4()), datetime.utcnow().replace(microsecond=0)
+    with session_factory(engine)() as session:
+        session.execute(text('CREATE TABLE origin (origin_ref CHAR(36) PRIMARY KEY, hostname VARCHAR(256), guest_driver_version VARCHAR(10), os_platform VARCHAR(256), os_version VARCHAR(256))'))
+        session.execute(text('CREATE TABLE lease (origin_ref CHAR(36) PRIMARY KEY, lease_ref CHAR(36), lease_created DATETIME, lease_expires DATETIME)'))
+        session.execute(text('CREATE UNIQUE INDEX ix_origin_origin_ref ON origin (origin_ref)'))  # redundant to primary-key
+        session.execute(text('INSERT INTO origin (origin_ref) VALUES (:o)'), dict(o=origin_ref))
+        session.execute(text('INSERT INTO lease VALUES (:o, :l, :c, :e)'), dict(o=origin_ref, l=lease_ref, c=cur_time, e=cur_time))
+        session.commit()
+
+    assert upgrade(engine) is True
+    assert SchemaVersion.get(engine) == SCHEMA_VERSION
+    db = inspect(engine)
+    assert db.get_pk_constraint('lease')['constrained_columns'] == ['lease_ref']
+    assert sorted(_['name'] for _ in db.get_indexes('lease')) == ['ix_lease_lease_expires', 'ix_lease_lease_updated', 'ix_lease_origin_ref_lease_expires']
+    assert db.get_indexes('origin') == []
+    assert 'scope_ref' in [_['name'] for _ in db.get_columns('lease')]
+    assert db.has_table('rate_limit') and db.has_table('lease_quota')
+
+    lease = Lease.find_by_lease_ref(engine, lease_ref)  # not dropped
+    assert lease.origin_ref == origin_ref and lease.lease_updated == cur_time and lease.scope_ref is None
+
+    # every migration checks if it is required, so they can run again
+    assert migrate(engine, 0) == SCHEMA_VERSION
+    assert Lease.find_by_lease_ref(engine, lease_ref) is not None
+
+
+def test_conditional_listings():
+    response = client.get('/-/config')
+    assert response.status_code == 200
+    response = client.get('/-/config', headers={'if-none-match': response.headers['etag']})
+    assert response.status_code == 304
+
+    response = client.get('/-/leases?origin=true')
+    etag = response.headers['etag']
+    assert client.get('/-/leases?origin=true', headers={'if-none-match': etag}).status_code == 304
+    assert client.get('/-/leases', headers={'if-none-match': etag}).status_code == 200  # other representation
+
+    origins = client.get('/-/origins?leases=true').headers['etag']
+    assert client.get('/-/origins?leases=true', headers={'if-none-match': origins}).status_code == 304
+
+    lease_ref = test_leasing_v1_lessor()
+    assert client.get('/-/leases?origin=true', headers={'if-none-match': etag}).status_code == 200
+    assert client.get('/-/origins?leases=true', headers={'if-none-match': origins}).status_code == 200
+
+    etag = client.get('/-/leases').headers['etag']
+    response = client.put(f'/leasing/v1/lease/{lease_ref}', headers={'authorization': __bearer_token(ORIGIN_REF)})
+    assert response.status_code == 200
+    assert client.get('/-/leases', headers={'if-none-match': etag}).status_code == 200  # renewed
+
+    origins = client.get('/-/origins').headers['etag']
+    test_auth_v1_origin()  # updates the origin
+    assert client.get('/-/origins', headers={'if-none-match': origins}).status_code == 200
+
+    client.delete('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+
+
+def test_rate_limits():
+    from concurrent.futures import ThreadPoolExecutor
+    from app.limits import TokenBuckets, ConcurrencyLimit
+    from app.orm import RateLimit
+
+    now = 0.0
+    buckets = TokenBuckets(rate=2, burst=2, maxsize=2, clock=lambda: now)
+    assert [buckets.acquire('a'), buckets.acquire('a')] == [0, 0]
+    assert buckets.acquire('a') == 0.5  # empty, refilled with 2 tokens per second
+    now = 0.25
+    assert buckets.acquire('a') == 0.25
+    now = 1.0
+    assert [buckets.acquire('a') for _ in range(3)] == [0, 0, 0.5]  # refilled up to "burst"
+    buckets.acquire('b'), buckets.acquire('c')
+    assert len(buckets) == 2 and buckets.acquire('a') == 0  # least recently used bucket ("a") was dropped
+
+    # shared buckets in the database behave the same
+    name = f'test:{uuid4()}'
+    assert [RateLimit.acquire(main.db, name, 2, 2, 100.0) for _ in range(2)] == [0, 0]
+    assert RateLimit.acquire(main.db, name, 2, 2, 100.0) == 0.5
+    assert RateLimit.acquire(main.db, name, 2, 2, 100.75) == 0 and RateLimit.acquire(main.db, name, 2, 2, 100.75) == 0.25
+    assert RateLimit.delete_idle(main.db, updated_before=101) >= 1
+    assert RateLimit.acquire(main.db, name, 2, 2, 101.0) == 0  # new (full) bucket
+
+    limits = dict(main.rate_limits)
+    try:
+        main.rate_limits['origin'] = TokenBuckets(rate=0.01, burst=1)
+        for _ in range(3):  # the origin_ref of unauthenticated requests is not trusted, they do not drain its bucket
+            test_auth_v1_origin()
+        response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert response.status_code == 200
+        response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+        assert response.status_code == 429 and response.headers['retry-after'] == '100'
+        response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(str(uuid4()))})
+        assert response.status_code == 200  # other origins are not limited
+
+        main.rate_limits['ip'] = TokenBuckets(rate=0.01, burst=2)
+        payload = {'auth_code': 'junk', 'code_verifier': SECRET}
+        assert client.post('/auth/v1/token', json=payload).status_code == 400
+        assert client.post('/auth/v1/token', json=payload).status_code == 400
+        assert client.post('/auth/v1/token', json=payload).status_code == 429  # limited before the code is verified
+    finally:
+        main.rate_limits.update(limits)
+
+    payload = {'code_challenge': 'challenge', 'origin_ref': ORIGIN_REF}
+    signing = main.signing_limit, main.signing_executor
+    try:
+        main.signing_limit, main.signing_executor = ConcurrencyLimit(1), ThreadPoolExecutor(max_workers=1)
+        test_auth_v1_code()  # signed in the thread-pool
+
+        main.signing_limit.active = 1  # pool is busy
+        response = client.post('/auth/v1/code', json=payload)
+        assert response.status_code == 429 and response.headers['retry-after'] == '1'
+        assert client.get('/-/health').status_code == 200
+    finally:
+        main.signing_executor.shutdown()
+        main.signing_limit, main.signing_executor = signing
+    assert 'dls_requests_limited_total{reason="signing"}' in client.get('/-/metrics').text
+
+
+def test_lease_deduplication_and_quota():
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import timedelta
+
+    def borrow(origin_ref: str, scope_refs: [str]):
+        payload = {'fulfillment_context': {'fulfillment_class_ref_list': []}, 'proposal_evaluation_mode': 'ALL_OF', 'scope_ref_list': scope_refs}
+        return client.post('/leasing/v1/lessor', json=payload, headers={'authorization': __bearer_token(origin_ref)})
+
+    origin_refs, scope_ref = [str(uuid4()), str(uuid4())], str(uuid4())
+    for origin_ref in origin_refs:
+        assert client.post('/auth/v1/origin', json={'candidate_origin_ref': origin_ref, 'environment': {}}).status_code == 200
+
+    first = borrow(origin_refs[0], [ALLOTMENT_REF]).json()['lease_result_list'][0]['lease']
+    second = borrow(origin_refs[0], [ALLOTMENT_REF, scope_ref]).json()['lease_result_list']
+    assert second[0]['lease']['ref'] == first['ref'] and second[0]['lease']['created'] == first['created']  # retried
+    assert second[0]['lease']['expires'] >= first['expires']  # renewed
+    assert second[1]['lease']['ref'] != first['ref']
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(origin_refs[0])})
+    assert len(response.json().get('active_lease_list')) == 2
+
+    # concurrent (retried) requests of an origin create only one lease per scope
+    origin_ref, cur_time = str(uuid4()), datetime.utcnow()
+    main.Origin.create_or_update(main.db, main.Origin(origin_ref=origin_ref))
+
+    def borrow_leases(origin_ref: str, *scope_refs: str, quota: int = 0, expires: datetime = cur_time + timedelta(days=1), **kwargs) -> (int, int, str):
+        leases = [main.Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), scope_ref=_, lease_created=cur_time, lease_expires=expires) for _ in scope_refs]
+        active, created, scope_ref = main.Lease.borrow(main.db, origin_ref, leases, cur_time, quota=quota, **kwargs)
+        return len(active), len(created), scope_ref
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: borrow_leases(origin_ref, ALLOTMENT_REF), range(8)))
+    assert sorted(results) == [(0, 1, None)] + [(1, 0, None)] * 7
+    assert len(main.Lease.find_by_origin_ref(main.db, origin_ref)) == 1
+    main.Origin.delete(main.db, [origin_ref])
+
+    # counter, slots are only taken together with the leases, active leases are recounted when the quota is reached
+    quota_scope_ref, other_scope_ref, new_scope_ref = str(uuid4()), str(uuid4()), str(uuid4())
+    origins = [str(uuid4()) for _ in range(4)]
+    for origin_ref in origins:
+        main.Origin.create_or_update(main.db, main.Origin(origin_ref=origin_ref))
+
+    assert borrow_leases(origins[0], other_scope_ref, quota_scope_ref, quota=2) == (0, 2, None)
+    assert borrow_leases(origins[0], other_scope_ref, quota_scope_ref, quota=2) == (2, 0, None)  # retried, no slots taken
+    assert borrow_leases(origins[1], other_scope_ref, quota_scope_ref, quota=2) == (0, 2, None)
+    assert borrow_leases(origins[2], new_scope_ref, quota_scope_ref, quota=2) == (0, 0, quota_scope_ref)
+    assert borrow_leases(origins[3], new_scope_ref, quota=1) == (0, 1, None)  # slot of the refused lease was not taken
+    assert borrow_leases(origins[2], quota_scope_ref, quota=2, recount_after=timedelta(0)) == (0, 0, quota_scope_ref)  # still active
+
+    main.Lease.cleanup(main.db, origins[0]), main.Lease.cleanup(main.db, origins[1])
+    assert borrow_leases(origins[3], quota_scope_ref, quota=3, expires=cur_time) == (0, 1, None)  # already expired, but counted
+    assert borrow_leases(origins[2], quota_scope_ref, quota=1, recount_after=timedelta(0)) == (0, 1, None)  # recounted
+    main.Origin.delete(main.db, origins)
+
+    quota = main.LEASE_QUOTA
+    try:
+        main.LEASE_QUOTA, quota_scope_ref = 1, str(uuid4())
+        assert borrow(origin_refs[0], [quota_scope_ref]).status_code == 200
+        assert borrow(origin_refs[0], [quota_scope_ref]).status_code == 200  # existing lease, no new one is taken
+        response = borrow(origin_refs[1], [quota_scope_ref])
+        assert response.status_code == 409
+    finally:
+        main.LEASE_QUOTA = quota
+
+
+def test_query_plans():
+    """hot queries must use an index, on sqlite and (if "TEST_DATABASE_POSTGRES" is set) on postgres"""
+    from datetime import timedelta
+    from os import environ
+    from re import search
+    from sqlalchemy import event, text
+    from app.orm import create_engine, upgrade, Origin, Lease
+
+    def hot_queries(engine) -> [(str, dict)]:
+        """runs the queries of the protocol endpoints, renewals and the reaper, returns their statements"""
+        statements = []
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def capture(connection, cursor, statement, parameters, context, executemany):
+            if search(r'\b(lease|origin)\b', statement) and not statement.startswith(('INSERT', 'CREATE', 'PRAGMA')):
+                statements.append((statement, parameters[0] if executemany else parameters))
+
+        origin_ref, lease_ref, now = str(uuid4()), str(uuid4()), datetime.utcnow()
+        Origin.create_or_update(engine, Origin(origin_ref=origin_ref))
+        Lease.create_many(engine, [Lease(origin_ref=origin_ref, lease_ref=lease_ref, scope_ref=ALLOTMENT_REF, lease_created=now, lease_expires=now)])
+        statements.clear()
+
+        Lease.find_by_origin_ref(engine, origin_ref)
+        Lease.find_by_lease_ref(engine, lease_ref)
+        Lease.find_by_origin_ref_and_lease_ref(engine, origin_ref, lease_ref)
+        Lease.find_active_by_origin_ref_and_scope_refs(engine, origin_ref, [ALLOTMENT_REF], now)
+        Lease.renew(engine, origin_ref, lease_ref, now, now)
+        Lease.renew_many(engine, [(origin_ref, lease_ref, now, now)])
+        Lease.count_active(engine, now + timedelta(days=1))
+        Lease.find_page(engine, after=lease_ref, limit=10, with_origin=True)
+        Origin.find_page(engine, after=origin_ref, limit=10, with_leases=True)
+        Lease.delete_expired_chunk(engine, now + timedelta(seconds=1), 10)
+        Lease.cleanup(engine, origin_ref)
+        Lease.delete(engine, lease_ref)
+        Origin.delete(engine, [origin_ref])
+        event.remove(engine, 'before_cursor_execute', capture)
+        return statements
+
+    engine = create_engine('sqlite://')
+    upgrade(engine)
+    for statement, parameters in hot_queries(engine):
+        with engine.connect() as connection:
+            plan = [_[-1] for _ in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+        assert not any(search(r'^SCAN (lease|origin)\b', _) for _ in plan), f'full table scan: {statement} {plan}'
+
+    # the count reads an index (no table has a cheaper one), but "max" must only read the end of its index
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    Lease.state(engine)
+    with engine.connect() as connection:
+        plan = [_[-1] for _ in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statements[-1]}')]
+    assert 'SEARCH lease USING COVERING INDEX ix_lease_lease_updated' in plan, plan
+
+    if environ.get('TEST_DATABASE_POSTGRES') is not None:
+        engine = create_engine(environ.get('TEST_DATABASE_POSTGRES'))
+        upgrade(engine)
+        for statement, parameters in hot_queries(engine):
+            with engine.connect() as connection:
+                connection.execute(text('SET enable_seqscan = off'))  # tables are tiny, so only an index avoids it
+                plan = '\n'.join(_[0] for _ in connection.exec_driver_sql(f'EXPLAIN {statement}', parameters))
+            assert not search(r'Seq Scan on (lease|origin)\b', plan), f'full table scan: {statement}\n{plan}'